@@ -0,0 +1,88 @@
+"""Benchmark of the capture -> detect throughput with the replay camera.
+
+The camera is replaced by the replay camera of conf/camera.yaml, which serves the recorded frame sets at
+the configured frame rate and gain latency, so the whole vision loop runs without the cell. Every cycle
+captures the images of all gains and detects the squares in them. The time of the capture and of the
+detection and the number of cycles per second are reported. Run from the repository root:
+
+    python -m benchmark.capture_throughput --cycles 20
+    python -m benchmark.capture_throughput --no-stream --detector full
+"""
+import json
+import time
+import argparse
+import statistics
+
+import yaml
+
+from src.image import set_up_camera, capture_images
+from src.acquisition import CameraStream
+from src.detection import detect_squares
+from src.incremental import IncrementalDetector
+
+
+def run(args) -> dict:
+    camera_config = yaml.safe_load(open(args.camera_config, 'r'))
+    detection_config = yaml.safe_load(open(args.detection_config, 'r'))
+
+    replay = camera_config.setdefault('replay', {})
+    replay['enabled'] = True
+    replay['directories'] = args.datasets or replay.get('directories', ['camera/images*'])
+    if args.fps is not None:
+        replay['fps'] = args.fps
+    if args.latency is not None:
+        replay['latency'] = args.latency
+    camera_config.setdefault('stream', {})['enabled'] = args.stream
+
+    camera = set_up_camera(camera_config)
+    detector = IncrementalDetector(detection_config) if args.detector == 'incremental' else None
+
+    capture_times, detection_times, squares = [], [], []
+    start = time.perf_counter()
+    for cycle in range(args.cycles):
+        t0 = time.perf_counter()
+        images = capture_images(camera, None, camera_config)
+        t1 = time.perf_counter()
+        found = detector.detect(images) if detector is not None else detect_squares(images, detection_config)
+        t2 = time.perf_counter()
+
+        capture_times.append(t1 - t0)
+        detection_times.append(t2 - t1)
+        squares.append(len(found))
+        print(f'cycle {cycle:3d}: capture {t1 - t0:6.3f} s, detection {t2 - t1:6.3f} s, {len(found)} squares')
+    total = time.perf_counter() - start
+
+    if isinstance(camera, CameraStream):
+        camera.close()
+
+    result = {'cycles': args.cycles, 'stream': args.stream, 'detector': args.detector,
+              'fps': replay.get('fps'), 'latency': replay.get('latency'),
+              'capture': statistics.median(capture_times), 'detection': statistics.median(detection_times),
+              'throughput': args.cycles / total, 'squares': squares}
+    print(f'\nmedian capture {result["capture"]:.3f} s, median detection {result["detection"]:.3f} s, '
+          f'{result["throughput"]:.2f} cycles/s')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('datasets', nargs='*', help='glob patterns of the frame sets (default: from the configuration)')
+    parser.add_argument('--camera-config', default='conf/camera.yaml')
+    parser.add_argument('--detection-config', default='conf/detection.yaml')
+    parser.add_argument('--cycles', type=int, default=10)
+    parser.add_argument('--fps', type=float, help='frame rate of the replayed camera')
+    parser.add_argument('--latency', type=float, help='delay of a gain change [s]')
+    parser.add_argument('--stream', action=argparse.BooleanOptionalAction, default=True,
+                        help='acquire the frames in the background thread')
+    parser.add_argument('--detector', choices=('incremental', 'full'), default='incremental')
+    parser.add_argument('--output', help='write the measurements to this JSON file')
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
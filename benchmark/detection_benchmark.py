@@ -0,0 +1,222 @@
+"""Benchmark of the square detection over the bundled image sets.
+
+Every stage of detect_squares is run separately and its wall time and peak traced memory
+(Python and numpy allocations) are recorded, together with the number of contours, square
+candidates, clusters and squares. Like in detect_squares, the threshold sweep is streamed: the
+contours of each threshold are approximated and filtered inside the sweep, so the polygon filter
+stage only merges the candidates of the channels. The squares are compared with a stored golden
+result: a square is stable if a golden square with the same color and id has its center within
+the tolerance.
+The records of a frame archive can be benchmarked instead of the image sets, their golden result
+are the squares recorded with them. Run from the repository root:
+
+    python -m benchmark.detection_benchmark --output run.json
+    python -m benchmark.detection_benchmark --archive output/archive
+    python -m benchmark.detection_benchmark --update-golden
+    python -m benchmark.detection_benchmark --compare base.json run.json
+"""
+import sys
+import json
+import time
+import resource
+import argparse
+import tracemalloc
+from contextlib import contextmanager
+
+import yaml
+import cv2 as cv
+
+from src.detection import load_images, prefilter_chain, threshold_candidates, stable_region_candidates, \
+    merge_candidates, cluster_candidates, representative_squares, suppress_nested_squares, \
+    assign_attributes, PREFILTERS, MIN_THRESHOLD, MAX_THRESHOLD, STEP, SHADES
+from src.archive import FrameArchive
+from benchmark.prefilter_report import find_datasets, compare
+
+STAGES = ('correction', 'filtering', 'threshold_sweep', 'polygon_filter', 'clustering', 'suppression', 'attributes')
+COUNTS = ('contours', 'candidates', 'clusters', 'squares')
+GOLDEN = 'benchmark/detection_golden.json'
+
+
+@contextmanager
+def measure(result: dict, stage: str):
+    """Adds the wall time of the block to the stage and updates its peak traced memory"""
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    yield
+    result['time'][stage] += time.perf_counter() - start
+    result['memory'][stage] = max(result['memory'][stage], tracemalloc.get_traced_memory()[1])
+
+
+def benchmark_set(images: dict, config: dict) -> tuple:
+    """Runs the detection stage by stage, the same way as the serial detect_squares
+    :return: list of squares and the measurements
+    """
+    result = {'time': dict.fromkeys(STAGES, 0.0), 'memory': dict.fromkeys(STAGES, 0), 'counts': dict.fromkeys(COUNTS, 0)}
+    engine = config.get('engine', 'sweep')
+    method = config.get('clustering', 'grid')
+    prefilter = prefilter_chain(config)
+
+    squares = []
+    for shade in SHADES:
+        img = images[shade].copy()
+        for stage in prefilter[shade]:
+            params = {key: value for key, value in stage.items() if key != 'type'}
+            with measure(result, 'correction' if stage['type'] == 'correction' else 'filtering'):
+                img = PREFILTERS[stage['type']](img, **params)
+
+        stats = {}
+        with measure(result, 'threshold_sweep'):
+            if engine == 'component_tree':
+                candidates = [stable_region_candidates(channel, config['component_tree'], stats)
+                              for channel in cv.split(img)]
+            else:
+                candidates = [threshold_candidates(channel, MIN_THRESHOLD, MAX_THRESHOLD, STEP, stats=stats)
+                              for channel in cv.split(img)]
+
+        with measure(result, 'polygon_filter'):
+            vectors, counts = merge_candidates(candidates)
+
+        with measure(result, 'clustering'):
+            labels = cluster_candidates(vectors, method=method)
+
+        with measure(result, 'suppression'):
+            shade_squares = suppress_nested_squares(representative_squares(vectors, counts, labels, mode='min'))
+
+        with measure(result, 'attributes'):
+            squares += assign_attributes(shade_squares, images[shade], config, shade)
+
+        result['counts']['contours'] += stats['contours']
+        result['counts']['candidates'] += len(vectors)
+        result['counts']['clusters'] += int(labels.max(initial=-1)) + 1
+        result['counts']['squares'] += len(shade_squares)
+
+    return squares, result
+
+
+def square_records(squares: list) -> list:
+    return [{'x': square.x, 'y': square.y, 'color': square.color, 'id': square.id} for square in squares]
+
+
+def run(args) -> dict:
+    config = yaml.safe_load(open(args.config, 'r'))
+    try:
+        golden = json.load(open(args.golden, 'r'))
+    except FileNotFoundError:
+        golden = {}
+
+    if args.archive:
+        # The records are named <archive>#<number>, the squares found in production are their golden result
+        archive = FrameArchive(args.archive)
+        datasets = {f'{args.archive}#{i}': i for i in range(len(archive))}
+        for dataset, i in datasets.items():
+            golden.setdefault(dataset, square_records(archive.square_set(i)))
+    else:
+        archive = None
+        datasets = args.datasets or find_datasets(['detection', 'camera'])
+
+    tracemalloc.start()
+    results, records = {}, {}
+    for dataset in datasets:
+        images = archive.images(datasets[dataset]) if archive is not None else load_images(dataset)
+        squares, result = benchmark_set(images, config)
+        records[dataset] = square_records(squares)
+
+        if dataset in golden:
+            # compare() only needs the attributes of the squares
+            reference = [argparse.Namespace(**record) for record in golden[dataset]]
+            stability = compare([argparse.Namespace(**record) for record in records[dataset]], reference, args.tolerance)
+            result['golden'] = {'matched': stability['matched'], 'reference': stability['reference']}
+        results[dataset] = result
+
+        golden_info = f', golden {result["golden"]["matched"]}/{result["golden"]["reference"]}' if 'golden' in result else ''
+        print(f'{dataset:20s} {sum(result["time"].values()):6.2f} s, {max(result["memory"].values()) / 2 ** 20:6.1f} MiB, '
+              + ', '.join(f'{result["counts"][count]} {count}' for count in COUNTS) + golden_info)
+    tracemalloc.stop()
+
+    if args.update_golden and archive is None:
+        golden.update(records)
+        with open(args.golden, 'w') as f:
+            # One image set per line keeps the diffs of the golden file readable
+            f.write('{\n' + ',\n'.join(f'{json.dumps(d)}: {json.dumps(golden[d])}' for d in sorted(golden)) + '\n}\n')
+        print(f'Golden result of {len(records)} image sets written to {args.golden}')
+
+    run_result = {'config': args.config, 'datasets': results,
+                  'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    print_summary(run_result)
+    return run_result
+
+
+def print_summary(run_result: dict):
+    results = run_result['datasets'].values()
+    print('\n| stage | time [s/set] | peak memory [MiB] |')
+    print('|---|---|---|')
+    for stage in STAGES:
+        mean_time = sum(r['time'][stage] for r in results) / max(len(results), 1)
+        peak = max((r['memory'][stage] for r in results), default=0) / 2 ** 20
+        print(f'| {stage} | {mean_time:.3f} | {peak:.1f} |')
+    print(f'\nPeak resident memory of the process: {run_result["peak_rss"] / 1024:.1f} MiB')
+
+    stable = sum(r['golden']['matched'] for r in results if 'golden' in r)
+    reference = sum(r['golden']['reference'] for r in results if 'golden' in r)
+    if reference:
+        print(f'Squares stable against the golden result: {stable}/{reference}')
+
+
+def compare_runs(base: dict, new: dict, threshold: float, min_time: float) -> list:
+    """Finds the regressions of the new run against the base run
+    :param threshold: relative increase of time or memory that is reported
+    :param min_time: stage time differences below this are ignored [s]
+    :return: list of messages
+    """
+    regressions = []
+    common = [dataset for dataset in new['datasets'] if dataset in base['datasets']]
+    for stage in STAGES:
+        base_time = sum(base['datasets'][d]['time'][stage] for d in common)
+        new_time = sum(new['datasets'][d]['time'][stage] for d in common)
+        if new_time > base_time * (1 + threshold) and new_time - base_time > min_time * len(common):
+            regressions.append(f'{stage}: time {base_time:.2f} s -> {new_time:.2f} s')
+
+        base_memory = max((base['datasets'][d]['memory'][stage] for d in common), default=0)
+        new_memory = max((new['datasets'][d]['memory'][stage] for d in common), default=0)
+        if new_memory > base_memory * (1 + threshold):
+            regressions.append(f'{stage}: peak memory {base_memory / 2 ** 20:.1f} MiB -> {new_memory / 2 ** 20:.1f} MiB')
+
+    for dataset in common:
+        b, n = base['datasets'][dataset], new['datasets'][dataset]
+        if n['counts']['squares'] != b['counts']['squares']:
+            regressions.append(f'{dataset}: {b["counts"]["squares"]} -> {n["counts"]["squares"]} squares')
+        if 'golden' in b and 'golden' in n and n['golden']['matched'] < b['golden']['matched']:
+            regressions.append(f'{dataset}: golden {b["golden"]["matched"]} -> {n["golden"]["matched"]} stable squares')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('datasets', nargs='*', help='image directories (default: all sets in detection/ and camera/)')
+    parser.add_argument('--config', default='conf/detection.yaml')
+    parser.add_argument('--archive', help='benchmark the records of this frame archive instead of the image sets')
+    parser.add_argument('--golden', default=GOLDEN, help='golden result the squares are compared with')
+    parser.add_argument('--update-golden', action='store_true', help='store the squares of this run as the golden result')
+    parser.add_argument('--tolerance', type=float, default=3, help='maximum distance of stable centers [px]')
+    parser.add_argument('--output', help='write the measurements to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='compare two runs instead of running')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative increase reported as a regression')
+    parser.add_argument('--min-time', type=float, default=0.02, help='ignored time difference per set [s]')
+    args = parser.parse_args()
+
+    if args.compare:
+        base, new = (json.load(open(path, 'r')) for path in args.compare)
+        regressions = compare_runs(base, new, args.threshold, args.min_time)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        print(f'{len(regressions)} regressions')
+        sys.exit(1 if regressions else 0)
+
+    run_result = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run_result, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Benchmark of the cold start time of the src package and of the main.py subcommands.
+
+Every target is run in a new Python process several times and the median wall time is reported,
+together with the heavy modules (matplotlib, scipy, sklearn, PyCapture2) that the target imported.
+The main.py subcommands are started with --help, which imports everything main.py needs but
+exits before the robot or the camera is used. Run from the repository root:
+
+    python -m benchmark.import_time
+    python -m benchmark.import_time --budget 1.5
+"""
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+HEAVY = ('matplotlib', 'scipy', 'sklearn', 'PyCapture2')
+
+# Python statements importing the package or a single name of it
+IMPORTS = {
+    'import src': 'import src',
+    'Commander': 'from src import Commander',
+    'detect_squares': 'from src import detect_squares',
+    'IncrementalDetector': 'from src import IncrementalDetector',
+    'calibrate': 'from src import calibrate',
+    'Graph': 'from src import Graph',
+}
+SUBCOMMANDS = ('demo', 'calibrate', 'insert')
+
+# Prints the heavy modules loaded by the statement
+PROBE = 'import sys, json; {statement}; print(json.dumps([m for m in {heavy} if m in sys.modules]))'
+
+
+def time_process(command: list, repeat: int) -> tuple:
+    """Runs the command in new processes
+    :return: median wall time and the output of the last run
+    """
+    times, output = [], ''
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), output
+
+
+def run(args) -> dict:
+    results = {}
+    baseline, _ = time_process([sys.executable, '-c', 'pass'], args.repeat)
+    print(f'{"interpreter":24s} {baseline:6.3f} s')
+
+    for name, statement in IMPORTS.items():
+        probe = PROBE.format(statement=statement, heavy=HEAVY)
+        seconds, output = time_process([sys.executable, '-c', probe], args.repeat)
+        heavy = json.loads(output.strip().splitlines()[-1])
+        results[name] = {'time': seconds, 'heavy': heavy}
+        print(f'{name:24s} {seconds:6.3f} s  {", ".join(heavy)}')
+
+    for command in SUBCOMMANDS:
+        seconds, _ = time_process([sys.executable, 'main.py', command, '--help'], args.repeat)
+        results[f'main.py {command}'] = {'time': seconds}
+        print(f'{"main.py " + command:24s} {seconds:6.3f} s')
+
+    return {'interpreter': baseline, 'targets': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs of every target')
+    parser.add_argument('--budget', type=float, help='maximum time of every target, exits with 1 if exceeded [s]')
+    parser.add_argument('--output', help='write the measurements to this JSON file')
+    args = parser.parse_args()
+
+    run_result = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run_result, f, indent=1)
+
+    if args.budget is not None:
+        over = [name for name, result in run_result['targets'].items() if result['time'] > args.budget]
+        for name in over:
+            print(f'OVER BUDGET {name}: {run_result["targets"][name]["time"]:.3f} s > {args.budget:.3f} s')
+        sys.exit(1 if over else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Benchmark of detect_squares with the process pool against the serial detection.
+
+Every image set is detected with each number of workers and the median wall time of several runs is
+reported, together with the time of the pre-filter chain of each shade, which runs as a single task in
+the pool. The squares found with workers > 1 are checked to be the same as the serial ones. The pool is
+started and warmed up before the timed runs. Run from the repository root:
+
+    python -m benchmark.parallel_detection
+    python -m benchmark.parallel_detection detection/images1 --workers 1 2 3 --repeat 5
+"""
+import os
+import json
+import time
+import argparse
+import statistics
+from copy import deepcopy
+
+import cv2 as cv
+import yaml
+
+from src.detection import detect_squares, load_images, prefilter_chain, preprocess, SHADES
+
+
+def time_detection(images: dict, config: dict, repeat: int) -> tuple:
+    """Detects the squares several times
+    :return: median wall time and the squares of the last run
+    """
+    squares = detect_squares(images, config)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        squares = detect_squares(images, config)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), squares
+
+
+def run(args) -> dict:
+    config = yaml.safe_load(open(args.config, 'r'))
+    print(f'{os.cpu_count()} CPUs, {cv.getNumThreads()} OpenCV threads')
+
+    results = {}
+    for dataset in args.datasets:
+        images = load_images(dataset)
+        prefilter = prefilter_chain(config)
+        filtering = {}
+        for shade in SHADES:
+            start = time.perf_counter()
+            preprocess(images[shade], shade, prefilter)
+            filtering[shade] = time.perf_counter() - start
+
+        result, reference = {'filtering': filtering, 'time': {}, 'identical': {}}, None
+        for workers in args.workers:
+            workers_config = deepcopy(config)
+            workers_config['workers'] = workers
+            seconds, squares = time_detection(images, workers_config, args.repeat)
+            found = sorted((square.x, square.y, square.area, square.color, square.id) for square in squares)
+            reference = found if reference is None else reference
+            result['time'][workers] = seconds
+            result['identical'][workers] = found == reference
+        results[dataset] = result
+
+        print(f'{dataset:20s} filtering ' + ', '.join(f'{shade} {seconds:6.2f} s' for shade, seconds in filtering.items())
+              + ' | ' + ', '.join(f'{workers} workers {seconds:6.2f} s' + ('' if result['identical'][workers] else ' DIFFERENT')
+                                  for workers, seconds in result['time'].items()))
+
+    return {'config': args.config, 'cpus': os.cpu_count(), 'opencv_threads': cv.getNumThreads(), 'datasets': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('datasets', nargs='*', default=['detection/images1'], help='image set directories')
+    parser.add_argument('--config', default='conf/detection.yaml', help='detection configuration')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 3], help='numbers of workers to compare')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs of every number of workers')
+    parser.add_argument('--output', help='write the measurements to this JSON file')
+    args = parser.parse_args()
+
+    run_result = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run_result, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Compares the pre-filter chains declared in conf/detection.yaml.
+
+Every chain is run over the bundled image sets and its squares are compared with the squares
+of the reference chain. A square matches if it has the same color and id and its center is
+within the tolerance. Run from the repository root:
+
+    python -m benchmark.prefilter_report --output benchmark/prefilter_report.md
+"""
+import os
+import time
+import argparse
+from copy import deepcopy
+
+import yaml
+import cv2 as cv
+import numpy as np
+
+from src.detection import load_images, preprocess, threshold_candidates, merge_candidates, \
+    squares_from_candidates, assign_attributes, MIN_THRESHOLD, MAX_THRESHOLD, STEP, SHADES
+
+
+def find_datasets(roots: list) -> list:
+    """Finds all directories with both a dark and a light image"""
+    datasets = []
+    for root in roots:
+        for directory in sorted(os.scandir(root), key=lambda d: d.name):
+            if directory.is_dir() and len(load_images(directory.path)) == len(SHADES):
+                datasets.append(directory.path)
+    return datasets
+
+
+def detect_with_chain(images: dict, config: dict, chain: dict) -> tuple:
+    """Runs the detection with the given pre-filter chain
+    :return: list of squares and the time spent in the pre-filter
+    """
+    squares, prefilter_time = [], 0
+    for shade in SHADES:
+        start = time.perf_counter()
+        filtered = preprocess(images[shade], shade, chain)
+        prefilter_time += time.perf_counter() - start
+
+        candidates = merge_candidates([threshold_candidates(channel, MIN_THRESHOLD, MAX_THRESHOLD, STEP)
+                                       for channel in cv.split(filtered)])
+        shade_squares = squares_from_candidates(*candidates, mode='min', method=config.get('clustering', 'grid'))
+        squares += assign_attributes(shade_squares, images[shade], config, shade)
+    return squares, prefilter_time
+
+
+def compare(squares: list, reference: list, tolerance: float) -> dict:
+    """Matches the squares to the reference squares"""
+    matched, errors, unmatched = 0, [], list(reference)
+    for square in squares:
+        for ref in unmatched:
+            distance = np.hypot(square.x - ref.x, square.y - ref.y)
+            if square.color == ref.color and square.id == ref.id and distance <= tolerance:
+                matched += 1
+                errors.append(distance)
+                unmatched.remove(ref)
+                break
+    return {'matched': matched, 'detected': len(squares), 'reference': len(reference),
+            'center_error': float(np.mean(errors)) if errors else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('datasets', nargs='*', help='image directories (default: all sets in detection/ and camera/)')
+    parser.add_argument('--config', default='conf/detection.yaml')
+    parser.add_argument('--reference', default='default', help='chain the others are compared with')
+    parser.add_argument('--chains', nargs='*', help='chains to compare (default: all)')
+    parser.add_argument('--tolerance', type=float, default=3, help='maximum distance of matched centers [px]')
+    parser.add_argument('--output', help='write the report to this markdown file')
+    args = parser.parse_args()
+
+    config = yaml.safe_load(open(args.config, 'r'))
+    chains = config['prefilter_chains']
+    names = [args.reference] + [name for name in (args.chains or chains) if name != args.reference]
+    datasets = args.datasets or find_datasets(['detection', 'camera'])
+
+    results = {name: [] for name in names}
+    for dataset in datasets:
+        images = load_images(dataset)
+        reference = None
+        for name in names:
+            chain_config = deepcopy(config)
+            chain_config['prefilter'] = name
+
+            start = time.perf_counter()
+            squares, prefilter_time = detect_with_chain(images, chain_config, chains[name])
+            total_time = time.perf_counter() - start
+
+            reference = squares if reference is None else reference
+            result = compare(squares, reference, args.tolerance)
+            result.update(dataset=dataset, prefilter_time=prefilter_time, total_time=total_time)
+            results[name].append(result)
+            print(f'{dataset:24s} {name:16s} {result["matched"]:3d}/{result["reference"]:3d} matched, '
+                  f'{result["detected"]:3d} detected, prefilter {prefilter_time:6.2f} s, total {total_time:6.2f} s')
+
+    lines = ['# Pre-filter chain comparison',
+             '',
+             f'Reference chain: `{args.reference}`, {len(datasets)} image sets, center tolerance {args.tolerance} px.',
+             '',
+             '| chain | recall | precision | mean center error [px] | prefilter [s/set] | total [s/set] |',
+             '|---|---|---|---|---|---|']
+    for name in names:
+        r = results[name]
+        matched = sum(x['matched'] for x in r)
+        recall = matched / max(sum(x['reference'] for x in r), 1)
+        precision = matched / max(sum(x['detected'] for x in r), 1)
+        error = np.mean([x['center_error'] for x in r if x['matched']] or [0])
+        lines.append(f'| {name} | {recall:.3f} | {precision:.3f} | {error:.2f} | '
+                     f'{np.mean([x["prefilter_time"] for x in r]):.2f} | {np.mean([x["total_time"] for x in r]):.2f} |')
+
+    lines += ['', '| image set | ' + ' | '.join(names) + ' |', '|---|' + '---|' * len(names)]
+    for i, dataset in enumerate(datasets):
+        cells = [f'{results[name][i]["matched"]}/{results[name][i]["reference"]} ({results[name][i]["detected"]})'
+                 for name in names]
+        lines.append(f'| {dataset} | ' + ' | '.join(cells) + ' |')
+    lines += ['', 'Cells are matched/reference squares, the number of detected squares is in parentheses.']
+
+    report = '\n'.join(lines) + '\n'
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,11 @@
-import os
+import argparse
 
 import yaml
-import cv2 as cv
 import numpy as np
 
 from src import calibrate, robCRS97, Commander, set_up_camera, robCRSgripper, move_cube, \
-    detect_squares, Cube, capture_images, visualize_squares, get_cubes2stack
+    detect_squares, Cube, capture_images, visualize_squares, get_cubes2stack, IncrementalDetector, record_to_jsonl, \
+    SquareSet, ArchiveRecorder, camera_view
 
 calib_cfg = yaml.safe_load(open('conf/calibration.yaml', 'r'))
 camera_cfg = yaml.safe_load(open('conf/camera.yaml', 'r'))
@@ -29,12 +29,10 @@ def detection_demo(directory: str, mode: str):
 
     camera = set_up_camera(camera_cfg)
     
-    capture_images(camera, directory, camera_cfg)
+    images = capture_images(camera, directory, camera_cfg)
+    image = images['dark'].copy()
 
-    image_path = os.path.join(directory, 'dark.png')
-    image = cv.imread(image_path)
-
-    squares = detect_squares(directory, detection_cfg)
+    squares = detect_squares(images, detection_cfg)
 
     visualize_squares(image, squares, mode)
 
@@ -72,19 +70,26 @@ def cube_insertion(hard_home: bool = False, mode: str = 'all'):
     # Initialize camera
     camera = set_up_camera(camera_cfg)
 
-    # Detect squares
-    capture_images(camera, camera_cfg['img_directory'], camera_cfg)
-    squares = detect_squares(camera_cfg['img_directory'], detection_cfg)
+    # Detect squares, after the first cycle only the parts of the scene changed by the robot are detected again
+    detector = IncrementalDetector(detection_cfg)
+    images = capture_images(camera, camera_cfg['img_directory'], camera_cfg)
+    squares = detector.detect(images)
     init_squares = {(square.id, square.color): square.id for square in squares}
 
+    # The next images are captured and detected as soon as the arm leaves the camera view
+    view = camera_view(A, b, images['dark'].shape)
+
+    # Keep the frames, squares and chosen cubes of every cycle to look at bad picks afterwards
+    recorder = ArchiveRecorder(camera_cfg['archive']) if camera_cfg.get('archive', {}).get('enabled') else None
+
     small_cube = None
 
     while True:
         # Capture images
-        capture_images(camera, camera_cfg['img_directory'], camera_cfg)
+        images = capture_images(camera, camera_cfg['img_directory'], camera_cfg)
 
         # detect squares in the images
-        squares = detect_squares(camera_cfg['img_directory'], detection_cfg)
+        squares = detector.detect(images)
 
         # Assign ids to squares
         for square in squares:
@@ -92,12 +97,10 @@ def cube_insertion(hard_home: bool = False, mode: str = 'all'):
                 square.parent_id = init_squares[(square.id, square.color)]
 
         # Visualize squares
-        image_path = os.path.join(camera_cfg['img_directory'], 'dark.png')
-        image = cv.imread(image_path)
-        visualize_squares(image, squares, 'parents')
+        visualize_squares(images['dark'].copy(), squares, 'parents')
 
         # Create cube objects and filter out unreachable cubes
-        cubes = [square.create_cube(A, b, motion_cfg) for square in squares]
+        cubes = list(SquareSet(squares).to_cubes(A, b, motion_cfg))
         print('Number of detected cubes: ', len(cubes))
 
         not_identified_cubes = [cube for cube in cubes if not cube.is_identified()]
@@ -119,6 +122,9 @@ def cube_insertion(hard_home: bool = False, mode: str = 'all'):
         # Get small and big cube for insertion
         small_cube, big_cube = get_cubes2stack(valid_cubes, small_cube, mode)
 
+        if recorder is not None:
+            recorder.record(images, squares, small_cube, big_cube)
+
         if small_cube is None or big_cube is None:
             break
 
@@ -126,13 +132,41 @@ def cube_insertion(hard_home: bool = False, mode: str = 'all'):
         init_squares[(small_cube.id, small_cube.color)] = big_cube.parent_id
 
         # Insert small cube into big cube
-        move_cube(commander, small_cube, big_cube,  motion_cfg['off_screen_position'])
+        move_cube(commander, small_cube, big_cube,  motion_cfg['off_screen_position'],
+                  view=view, view_margin=motion_cfg.get('view_margin', 0))
+
+    if recorder is not None:
+        recorder.close()
 
 
 def main():
-    # detection_demo('camera/test', 'ids')
-    cube_insertion(True, 'all')
-    # get_transformation(False)
+    parser = argparse.ArgumentParser(description='Cube insertion with the CRS robot')
+    commands = parser.add_subparsers(dest='command')
+
+    insert = commands.add_parser('insert', help='insert the cubes into each other (default)')
+    insert.add_argument('--hard-home', action='store_true', help='home the robot before the insertion')
+    insert.add_argument('--mode', default='all', help='mode of the cube selection')
+
+    demo = commands.add_parser('demo', help='detect the squares in a captured image and show them')
+    demo.add_argument('--directory', default='camera/test', help='directory of the images')
+    demo.add_argument('--mode', default='ids', help="'centers', 'areas', 'ids' or 'images'")
+
+    calibration = commands.add_parser('calibrate', help='calibrate the camera to robot transformation')
+    calibration.add_argument('--hard-home', action='store_true', help='home the robot before the calibration')
+
+    args = parser.parse_args()
+
+    if detection_cfg.get('instrumentation'):
+        record_to_jsonl(detection_cfg['instrumentation'])
+
+    if args.command == 'demo':
+        detection_demo(args.directory, args.mode)
+    elif args.command == 'calibrate':
+        get_transformation(args.hard_home)
+    elif args.command == 'insert':
+        cube_insertion(args.hard_home, args.mode)
+    else:
+        cube_insertion(True, 'all')
 
 
 if __name__ == '__main__':
@@ -32,10 +32,102 @@
 
 import sys
 import time
+import queue
+import threading
+from typing import NamedTuple
 
 import numpy as np
 import serial
 
+# Kinds of the messages of the control unit
+READY = 'ready'  # R! or R<axis>!, the key is the axis
+FAIL = 'fail'  # FAIL!
+STAMP = 'stamp'  # STAMP=<stamp>
+VALUE = 'value'  # <query>=<value>
+ERROR = 'error'  # the reader stopped on an error of the serial interface
+
+
+class Message(NamedTuple):
+    kind: str
+    key: str = ''
+    value: str = ''
+
+
+def parse_line(line: str):
+    """
+    Parse a line of the control unit response.
+    :param line: Line without the line ending.
+    :return: Typed message, or None for other lines (e.g. echoed commands), nothing waits for them.
+    """
+    line = line.strip()
+    if line == 'FAIL!':
+        return Message(FAIL)
+    if line.startswith('R') and line.endswith('!'):
+        return Message(READY, line[1:-1])
+    key, sep, value = line.partition('=')
+    if sep:
+        return Message(STAMP if key == 'STAMP' else VALUE, key, value)
+    return None
+
+
+class LineReader:
+    """
+    Reads the responses of the control unit in a background thread, splits them into lines and puts
+    the parsed messages into a queue. The thread blocks on the serial interface, so the waiting for
+    a response costs no CPU time.
+    """
+
+    def __init__(self, rcon):
+        """
+        LineReader constructor.
+        :param rcon: Serial interface, its timeout is the period of checking whether to stop.
+        """
+        self.rcon = rcon
+        self.messages = queue.SimpleQueue()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='commander-reader', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        pending = b''
+        while self.running:
+            try:
+                data = self.rcon.read(1)
+                if data:
+                    data += self.rcon.read(self.rcon.in_waiting)
+            except (serial.SerialException, OSError, TypeError) as e:
+                # TypeError is raised by pyserial when the port is closed while reading
+                if self.running:
+                    self.messages.put(Message(ERROR, value=str(e)))
+                return
+            if not data:
+                continue
+
+            # Only the incomplete line and the new data are split, "\r\n" gives an empty line that is skipped
+            *lines, pending = (pending + data).replace(b'\r', b'\n').split(b'\n')
+            for line in lines:
+                message = parse_line(line.decode('ascii', errors='replace')) if line else None
+                if message is not None:
+                    self.messages.put(message)
+
+    def clear(self):
+        """
+        Drop the received messages.
+        """
+        while True:
+            try:
+                self.messages.get_nowait()
+            except queue.Empty:
+                return
+
+    def stop(self):
+        """
+        Stop the thread, it ends after the current read.
+        """
+        self.running = False
+        if self.thread is not threading.current_thread():
+            self.thread.join(timeout=1)
+
 
 class Commander:
 
@@ -47,6 +139,7 @@ class Commander:
         """
         self.robot = robot
         self.rcon = rcon  # type: serial.Serial
+        self.reader = LineReader(rcon) if rcon is not None else None
         self.stamp = int(time.time() % 0x7fff)
         self.last_trgt_irc = None
         self.coordmv_commands_to_next_check = 0
@@ -57,10 +150,15 @@ class Commander:
         Set communication interface.
         :param rcon: Serial interface.
         """
+        if self.reader is not None:
+            self.reader.stop()
+            self.reader = None
         if self.rcon is not None:
             self.rcon.close()
             self.rcon = None
         self.rcon = rcon
+        if rcon is not None:
+            self.reader = LineReader(rcon)
 
     def send_cmd(self, cmd):
         """
@@ -70,18 +168,26 @@ class Commander:
         ba = bytearray(cmd, 'ascii')
         self.rcon.write(ba)
 
-    def read_resp(self, maxbytes):
+    def wait_message(self, match, timeout=None):
         """
-        Read response from command unit.
-        :param maxbytes: Max number of bytes to read.
+        Wait for a message of the control unit, the messages before it are dropped.
+        :param match: Function returning True for the awaited message.
+        :param timeout: Maximal time to wait in seconds, None to wait forever.
+        :return: The message, or None after the timeout.
         """
-        resp = self.rcon.read(maxbytes)
-        if resp is None:
-            return None
-        s = resp.decode("ascii")
-        s = s.replace("\r\n", "\n")
-        s = s.replace("\r", "\n")
-        return s
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            try:
+                message = self.reader.messages.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if message.kind == ERROR:
+                raise serial.SerialException('Reading from the control unit failed: %s' % message.value)
+            if match(message):
+                return message
 
     def irctoangles(self, a):
         """
@@ -189,20 +295,8 @@ class Commander:
         """
         self.stamp = (self.stamp + 1) & 0x7fff
         self.send_cmd('STAMP:%d\n' % self.stamp)
-        buf = '\n'
-        while True:
-            buf += self.read_resp(1024)
-            i = buf.find('\n' + 'STAMP=')
-            if i < 0:
-                continue
-            s = '%d' % self.stamp
-            r = buf[i + 7:]
-            j = r.find('\n')
-            if j < 0:
-                continue
-            r = r[0:j].strip()
-            if r == s:
-                break
+        s = '%d' % self.stamp
+        self.wait_message(lambda m: m.kind == STAMP and m.value.strip() == s)
 
     def check_ready(self, for_coordmv_queue=False):
         """
@@ -270,7 +364,7 @@ class Commander:
         """
         Initialize communication through serial interface.
         """
-        s = self.read_resp(1024)
+        self.reader.clear()
         self.send_cmd("\nECHO:0\n")
         self.sync_cmd_fifo()
         s = self.query('VER')
@@ -392,7 +486,7 @@ class Commander:
             axis_lst = self.robot.coord_axes
         resp = self.query('COORDAP')
         try:
-            resp = np.array(map(int, resp.split(',')))
+            resp = np.array(list(map(int, resp.split(','))))
         except:
             print('Error responce', resp)
         t = resp[0]
@@ -437,20 +531,8 @@ class Commander:
         :param query: Query to send.
         :return: Control unit's response.
         """
-        buf = '\n'
         self.send_cmd('\n' + query + '?\n')
-        while True:
-            buf += self.read_resp(1024)
-            i = buf.find('\n' + query + '=')
-            if i < 0:
-                continue
-            j = buf[i + 1:].find('\n')
-            if j != -1:
-                break
-        if buf[i + 1 + j - 1] == '\r':
-            j -= 1
-        res = buf[i + 2 + len(query):i + 1 + j]
-        return res
+        return self.wait_message(lambda m: m.kind == VALUE and m.key == query).value
 
     def command(self, command):
         """
@@ -508,16 +590,11 @@ class Commander:
         Wait for control unit to be ready.
         :param sync: Boolean, whether to synchronize with control unit.
         """
-        buf = '\n'
         if sync:
             self.sync_cmd_fifo()
         self.send_cmd("\nR:\n")
-        while True:
-            buf += self.read_resp(1024)
-            if buf.find('\nR!') >= 0:
-                return True
-            if buf.find('\nFAIL!') >= 0:
-                return False
+        message = self.wait_message(lambda m: m.kind == FAIL or m.kind == READY and m.key == '')
+        return message.kind == READY
 
     def wait_gripper_ready(self):
         """
@@ -526,31 +603,29 @@ class Commander:
         if not hasattr(self.robot, 'gripper_ax'):
             raise Exception('This robot has no gripper_ax defined.')
 
-        self.send_cmd('\nR%s:\n' % self.robot.gripper_ax)
-        self.rcon.timeout = 2
+        axis = self.robot.gripper_ax
+        self.send_cmd('\nR%s:\n' % axis)
+        message = self.wait_message(lambda m: m.kind == FAIL or m.kind == READY and m.key == axis, timeout=2)
+        if message is None:
+            return
 
-        s = self.read_resp(1024)
-        self.rcon.timeout = 0.01
-        if s.find('R%s!\r\n' % self.robot.gripper_ax) >= 0:
+        if message.kind == READY:
+            # Poll the position until the gripper stops
             last = float('inf')
             while True:
-                self.send_cmd('AP%s?\n' % self.robot.gripper_ax)
-                s = self.read_resp(1024)
-
-                if s.find('\nFAIL!') >= 0:
+                self.send_cmd('AP%s?\n' % axis)
+                message = self.wait_message(lambda m: m.kind == FAIL or m.kind == VALUE and m.key == 'AP' + axis)
+                if message.kind == FAIL:
                     raise Exception('Command \'AP\' returned \'FAIL!\n')
-                ifs = s.find('AP%s=' % self.robot.gripper_ax)
-                if ifs >= 0:
-                    ifl = s.find('\r\n')
-                    p = float(s[ifs + 4:ifl])
+                p = float(message.value)
                 if abs(last - p) < self.robot.gripper_poll_diff:
                     break
                 last = p
-            time.sleep(self.robot.gripper_poll_time / 100)
+                time.sleep(self.robot.gripper_poll_time / 100)
 
-        elif s.find('\nFAIL!') >= 0:
+        else:
             self.wait_ready()
-            raise Exception('Command \'R:%s\' returned \'FAIL!\'' % self.robot.gripper_ax)
+            raise Exception('Command \'R:%s\' returned \'FAIL!\'' % axis)
 
     def open_comm(self, tty_dev, speed=19200):
         """
@@ -565,7 +640,7 @@ class Commander:
                             parity=serial.PARITY_NONE,
                             stopbits=serial.STOPBITS_ONE,
                             rtscts=True,
-                            timeout=0.01)
+                            timeout=0.1)
 
         self.set_rcon(ser)
         self.init_communication()
@@ -1,17 +1,57 @@
-from .graph import Graph
+import importlib
+
+# These functions share the name of their module, they are bound before any import of the submodule
+# could set the package attribute to the module itself
 from .robCRSdkt import robCRSdkt
 from .robCRSikt import robCRSikt
-from .CRS_commander import Commander
 from .robCRSgripper import robCRSgripper
-from .robotCRS import robCRS93, robCRS97
-from .interpolation import interpolate_poly, \
-    interpolate_b_spline, interpolate_p_spline
-
-from .calibration import calibrate
-from .detection import detect_squares
-from .planning import get_cubes2stack
-from .visualization import visualize_squares
-from .motion import move_cube, move, center_cube
-from .image import set_up_camera, capture_images
-from .objects import ApproxPolygon, Square, Cube
 
+# The names are loaded from their modules on first access, so that e.g. importing the Commander
+# does not import matplotlib, scipy or the camera library
+_exports = {
+    'Graph': '.graph',
+    'Commander': '.CRS_commander',
+    'robCRS93': '.robotCRS',
+    'robCRS97': '.robotCRS',
+    'interpolate_poly': '.interpolation',
+    'interpolate_b_spline': '.interpolation',
+    'interpolate_p_spline': '.interpolation',
+
+    'calibrate': '.calibration',
+    'detect_squares': '.detection',
+    'iter_squares': '.detection',
+    'iter_squares_async': '.detection',
+    'IncrementalDetector': '.incremental',
+    'collect': '.instrumentation',
+    'record_to_jsonl': '.instrumentation',
+    'stop_recording': '.instrumentation',
+    'get_cubes2stack': '.planning',
+    'visualize_squares': '.visualization',
+    'move_cube': '.motion',
+    'move': '.motion',
+    'center_cube': '.motion',
+    'camera_view': '.motion',
+    'set_up_camera': '.image',
+    'capture_images': '.image',
+    'FrameArchive': '.archive',
+    'ArchiveRecorder': '.archive',
+    'ApproxPolygon': '.objects',
+    'Square': '.objects',
+    'Cube': '.objects',
+    'SquareSet': '.objects',
+    'CubeSet': '.objects',
+}
+
+__all__ = ['robCRSdkt', 'robCRSikt', 'robCRSgripper'] + list(_exports)
+
+
+def __getattr__(name: str):
+    if name not in _exports:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(_exports[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports))
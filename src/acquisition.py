@@ -0,0 +1,204 @@
+import time
+import threading
+from collections import deque
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+try:
+    import PyCapture2
+except ImportError:
+    # The replay camera uses the same constants
+    from . import replay as PyCapture2
+
+# Only every n-th pixel in both directions is used for the brightness of a frame
+BRIGHTNESS_STEP = 8
+# The embedded gain is the lower 12 bits of the gain register
+GAIN_MASK = 0xFFF
+
+
+class Frame(NamedTuple):
+    image: np.ndarray
+    timestamp: float
+    gain: Optional[int]
+    brightness: float
+
+
+class FramePool:
+    """Preallocated frame buffers that are reused in turn, so that a long run does not allocate a new
+    array for every frame. The buffers of a key are reallocated only when the frame shape changes.
+    A buffer is overwritten after 'count' further frames of the same key.
+    """
+
+    def __init__(self, count: int = 2):
+        """
+        :param count: number of buffers per key
+        """
+        self.count = count
+        self.buffers = {}
+        self.turns = {}
+
+    def buffer(self, key, shape: tuple, dtype=np.uint8) -> np.ndarray:
+        """Returns the next buffer of the key"""
+        buffers = self.buffers.get(key)
+        if buffers is None or buffers[0].shape != shape or buffers[0].dtype != dtype:
+            buffers = self.buffers[key] = [np.empty(shape, dtype) for _ in range(self.count)]
+            self.turns[key] = 0
+
+        turn = self.turns[key]
+        self.turns[key] = (turn + 1) % self.count
+        return buffers[turn]
+
+    def store(self, key, image: np.ndarray) -> np.ndarray:
+        """Copies the image into the next buffer of the key"""
+        buffer = self.buffer(key, image.shape, image.dtype)
+        np.copyto(buffer, image)
+        return buffer
+
+
+def frame_view(image) -> np.ndarray:
+    """Wraps the data of a converted BGR PyCapture2 image without copying, valid while the image exists"""
+    return np.frombuffer(image.getData(), dtype=np.uint8).reshape((image.getRows(), image.getCols(), 3))
+
+
+class CameraStream:
+    """Acquires the frames of the camera continuously in a background thread.
+    The frames are converted to BGR arrays in the thread and kept in a ring buffer with the time they were
+    retrieved, their mean brightness and, if the camera embeds it, the gain register they were taken with.
+    The ring buffer uses 'buffer_size' + 1 preallocated buffers, the thread writes only to the one that is not
+    in the ring, and the captured frames are copied out of the ring to a pool of their own.
+    After the gain is changed, capture returns the first frame taken with the new gain: the frame with the new
+    embedded gain, or the first frame whose brightness moved away from the frames before the change and then
+    stopped changing. With the embedded gain, capture waits for the matching frame until 'timeout' and then
+    raises TimeoutError. Without it, the newest frame is used if the brightness did not settle within
+    'settle_time'.
+    """
+
+    def __init__(self, camera, config: dict):
+        """
+        :param camera: PyCapture2 camera object, capturing
+        :param config: camera configuration, the 'stream' section sets the parameters
+        """
+        self.camera = camera
+        params = config.get('stream', {})
+        self.tolerance = params.get('tolerance', 0.02)
+        self.settle_time = params.get('settle_time', 0.3)
+        self.timeout = params.get('timeout', 2.0)
+
+        buffer_size = params.get('buffer_size', 8)
+        self.frames = deque(maxlen=buffer_size)
+        self.ring = FramePool(buffer_size + 1)
+        self.pool = FramePool()
+        self.condition = threading.Condition()
+        self.metadata = params.get('metadata', True) and self.enable_metadata()
+        self.gain = None
+        self.gain_time = 0.0
+        self.gain_register = None
+        self.reference = None
+        self.error = None
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='camera-stream', daemon=True)
+        self.thread.start()
+
+    def enable_metadata(self) -> bool:
+        """Lets the camera embed the gain in the frames, returns False if it does not support it"""
+        try:
+            self.camera.setEmbeddedImageInfo(gain=True)
+        except Exception:
+            # AttributeError for cameras without the call, PyCapture2.Fc2error if the info is not supported
+            return False
+        return True
+
+    def run(self):
+        while self.running:
+            try:
+                raw = self.camera.retrieveBuffer()
+            except Exception as error:
+                with self.condition:
+                    self.error = error
+                    self.condition.notify_all()
+                return
+            timestamp = time.monotonic()
+
+            gain = raw.getMetadata().embeddedGain & GAIN_MASK if self.metadata else None
+            converted = raw.convert(PyCapture2.PIXEL_FORMAT.BGR)
+            image = self.ring.store('frames', frame_view(converted))
+            brightness = float(image[::BRIGHTNESS_STEP, ::BRIGHTNESS_STEP].mean())
+
+            with self.condition:
+                self.frames.append(Frame(image, timestamp, gain, brightness))
+                self.condition.notify_all()
+
+    def set_gain(self, value: float):
+        """Sets the gain, the frames retrieved after this call are candidates of the next capture"""
+        changed = value != self.gain
+        self.camera.setProperty(type=PyCapture2.PROPERTY_TYPE.GAIN, absValue=value)
+        register = self.camera.getProperty(PyCapture2.PROPERTY_TYPE.GAIN).valueA if self.metadata else None
+
+        with self.condition:
+            self.gain = value
+            self.gain_time = time.monotonic()
+            self.gain_register = register & GAIN_MASK if register is not None else None
+            # Without a gain change there is no transition to wait for
+            self.reference = self.frames[-1].brightness if self.frames and changed else None
+
+    def capture(self, gain: float) -> np.ndarray:
+        """Sets the gain and returns the first frame taken with it
+        :param gain: absolute value of the gain
+        :return: BGR image, reused after two further captures with the same gain
+        """
+        self.set_gain(gain)
+        with self.condition:
+            # The frame stays in the ring while the lock is held, the thread cannot overwrite it
+            return self.pool.store(gain, self.wait_settled().image)
+
+    def wait_settled(self) -> Frame:
+        settle_deadline = self.gain_time + self.settle_time
+        deadline = self.gain_time + self.timeout
+        with self.condition:
+            while True:
+                if self.error is not None:
+                    raise RuntimeError('Camera acquisition stopped') from self.error
+
+                frames = [frame for frame in self.frames if frame.timestamp > self.gain_time]
+                frame = self.settled_frame(frames)
+                if frame is not None:
+                    return frame
+
+                # Without the embedded gain the newest frame is the best guess, with it a frame taken with
+                # another gain is never returned
+                now = time.monotonic()
+                fallback = frames and self.gain_register is None
+                if fallback and now >= settle_deadline:
+                    return frames[-1]
+                if now >= deadline:
+                    raise TimeoutError(f'No frame with the gain {self.gain} retrieved within {self.timeout} s '
+                                       f'after the gain change')
+                self.condition.wait((settle_deadline if fallback else deadline) - now)
+
+    def settled_frame(self, frames: list) -> Optional[Frame]:
+        """Finds the first frame taken with the new gain among the frames retrieved after the change"""
+        if self.gain_register is not None:
+            return next((frame for frame in frames if frame.gain == self.gain_register), None)
+        if self.reference is None:
+            return frames[0] if frames else None
+
+        # The brightness has to leave the level before the change and then stay
+        for i, frame in enumerate(frames[:-1]):
+            if abs(frame.brightness - self.reference) > self.tolerance * max(self.reference, 1):
+                for previous, current in zip(frames[i:], frames[i + 1:]):
+                    if abs(current.brightness - previous.brightness) <= self.tolerance * max(previous.brightness, 1):
+                        return current
+                return None
+        return None
+
+    def latest(self) -> Optional[Frame]:
+        """Newest frame, its image is overwritten when it leaves the ring buffer"""
+        with self.condition:
+            return self.frames[-1] if self.frames else None
+
+    def close(self):
+        """Stops the acquisition thread, the camera keeps capturing"""
+        self.running = False
+        self.thread.join(timeout=self.timeout)
@@ -0,0 +1,225 @@
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .objects import SquareSet, CubeSet, SQUARE_DTYPE, CUBE_DTYPE, NO_ID, optional_id
+
+HEADER = 'archive.json'
+FRAMES = 'frames.dat'
+SQUARES = 'squares.dat'
+INDEX = 'index.dat'
+
+# Cycle of the run, time of the record, number of squares and the chosen cube pair (id NO_ID if there was none)
+INDEX_DTYPE = np.dtype([('cycle', np.int64), ('time', np.float64), ('squares', np.int32),
+                        ('small', CUBE_DTYPE), ('big', CUBE_DTYPE), ('written', np.bool_)])
+
+
+class FrameArchive:
+    """Append-only archive of the captured frames, the detected squares and the chosen cube pair of every cycle.
+    The records have a fixed size, so the frames, squares and index are memory-mapped files that are
+    read by record number without loading the rest of the archive:
+
+        archive.json  shades, frame shape and maximum number of squares of a record
+        frames.dat    uint8 array (records, shades, height, width, 3)
+        squares.dat   SQUARE_DTYPE array (records, max_squares)
+        index.dat     INDEX_DTYPE array (records,)
+
+    The index row is written last, a record counts only when its 'written' flag is set, so a run that
+    was killed while writing leaves a readable archive. The files grow by 'grow' records at a time.
+    """
+
+    def __init__(self, directory: str, mode: str = 'r', shades: list = None, frame_shape: tuple = None,
+                 max_squares: int = 256, grow: int = 64):
+        """
+        :param directory: directory of the archive
+        :param mode: 'r' to read, 'a' to append (the archive is created if it does not exist)
+        :param shades: names of the frames of a record, needed to create the archive
+        :param frame_shape: shape of a frame (height, width, 3), needed to create the archive
+        :param max_squares: maximum number of squares of a record, the rest is not stored
+        :param grow: number of records the files grow by
+        """
+        self.directory = directory
+        self.mode = mode
+        self.grow = grow
+
+        header_path = os.path.join(directory, HEADER)
+        if os.path.exists(header_path):
+            header = json.load(open(header_path, 'r'))
+        elif mode == 'a' and shades is not None and frame_shape is not None:
+            header = {'shades': list(shades), 'frame_shape': list(frame_shape), 'max_squares': max_squares}
+            os.makedirs(directory, exist_ok=True)
+            with open(header_path, 'w') as f:
+                json.dump(header, f)
+        else:
+            raise FileNotFoundError(f'No archive in {directory}')
+
+        self.shades = header['shades']
+        self.frame_shape = tuple(header['frame_shape'])
+        self.max_squares = header['max_squares']
+
+        self.capacity = 0
+        self.frames = self.squares = self.index = None
+        self.open_files()
+        self.length = self.count_records()
+
+    def open_files(self, capacity: int = None):
+        """Maps the files, when appending they are extended to the capacity (default their size or 'grow')"""
+        index_path = os.path.join(self.directory, INDEX)
+        size = os.path.getsize(index_path) // INDEX_DTYPE.itemsize if os.path.exists(index_path) else 0
+        capacity = max(size, capacity or 0, self.grow if self.mode == 'a' else 0)
+        self.frames = self.squares = self.index = None
+        self.capacity = capacity
+        if capacity == 0:
+            return
+
+        arrays = []
+        for name, shape, dtype in self.layout(capacity):
+            path = os.path.join(self.directory, name)
+            if self.mode == 'a':
+                # The new records are zeros, their index rows are not written
+                with open(path, 'ab') as f:
+                    f.truncate(int(np.prod(shape)) * dtype.itemsize)
+            arrays.append(np.memmap(path, dtype=dtype, mode='r' if self.mode == 'r' else 'r+', shape=shape))
+        self.frames, self.squares, self.index = arrays
+
+    def layout(self, capacity: int) -> list:
+        return [(FRAMES, (capacity, len(self.shades)) + self.frame_shape, np.dtype(np.uint8)),
+                (SQUARES, (capacity, self.max_squares), SQUARE_DTYPE),
+                (INDEX, (capacity,), INDEX_DTYPE)]
+
+    def count_records(self) -> int:
+        if self.capacity == 0:
+            return 0
+        unwritten = np.flatnonzero(~self.index['written'])
+        return int(unwritten[0]) if len(unwritten) else self.capacity
+
+    def refresh(self):
+        """Maps the files again to see the records appended by a writer in another process"""
+        self.open_files()
+        self.length = self.count_records()
+
+    def __len__(self):
+        return self.length
+
+    def images(self, i: int) -> dict:
+        """Frames of the record keyed by shade, read-only views of the mapped file"""
+        self.check(i)
+        return {shade: self.frames[i, j] for j, shade in enumerate(self.shades)}
+
+    def square_data(self, i: int) -> np.ndarray:
+        self.check(i)
+        return self.squares[i, :self.index[i]['squares']]
+
+    def square_set(self, i: int) -> SquareSet:
+        """Squares of the record, with their Square objects"""
+        return SquareSet.from_data(np.array(self.square_data(i)))
+
+    def cubes(self, i: int, motion_config) -> CubeSet:
+        """Chosen small and big cube of the record, the missing ones are left out"""
+        self.check(i)
+        pair = np.array([self.index[i]['small'], self.index[i]['big']])
+        return CubeSet(pair[pair['id'] != NO_ID], motion_config)
+
+    def check(self, i: int):
+        if not 0 <= i < self.length:
+            raise IndexError(f'Record {i} out of range, the archive has {self.length} records')
+
+    def append(self, images: dict, squares: np.ndarray, pair: np.ndarray, cycle: int) -> int:
+        """Writes a record
+        :param images: frames keyed by shade
+        :param squares: SQUARE_DTYPE array
+        :param pair: CUBE_DTYPE array with the small and the big cube
+        :param cycle: number of the cycle
+        :return: number of the record
+        """
+        i = self.length
+        if i >= self.capacity:
+            self.flush()
+            self.open_files(self.capacity + self.grow)
+
+        for j, shade in enumerate(self.shades):
+            if images[shade].shape != self.frame_shape:
+                raise ValueError(f'Frame shape {images[shade].shape} differs from the archive {self.frame_shape}')
+            self.frames[i, j] = images[shade]
+        count = min(len(squares), self.max_squares)
+        self.squares[i, :count] = squares[:count]
+
+        # The index row is written last and marks the record complete
+        self.index[i] = (cycle, time.time(), count, pair[0], pair[1], True)
+        self.length += 1
+        return i
+
+    def flush(self):
+        for array in (self.frames, self.squares, self.index):
+            if array is not None and self.mode == 'a':
+                array.flush()
+
+
+class ArchiveRecorder:
+    """Appends the records to a FrameArchive in a background thread.
+    The archive is created on the first record, with the shades and frame shape of its images. Like the
+    background save of the images, a record waits for the previous write, so the frames are read before
+    the buffers of the capture are reused.
+    """
+
+    def __init__(self, config: dict):
+        """
+        :param config: the 'archive' section of the camera configuration
+        """
+        self.directory = config.get('directory', 'output/archive')
+        self.max_squares = config.get('max_squares', 256)
+        self.grow = config.get('grow', 64)
+        self.flush_every = config.get('flush_every', 1)
+
+        self.archive = None
+        self.cycle = 0
+        self.writing = None
+        self.writer = ThreadPoolExecutor(max_workers=1)
+
+    def record(self, images: dict, squares: list, small_cube=None, big_cube=None):
+        """Archives the images of a cycle with its squares and chosen cube pair
+        :param images: images keyed by shade, must not be modified until the next record
+        :param squares: list of squares
+        :param small_cube: chosen small cube or None
+        :param big_cube: chosen big cube or None
+        :return: future of the write
+        """
+        # The squares and cubes are converted now, they may be changed after the call
+        data = SquareSet(squares).data
+        pair = np.array([cube_row(small_cube), cube_row(big_cube)], dtype=CUBE_DTYPE)
+
+        self.wait()
+        self.writing = self.writer.submit(self.write, images, data, pair, self.cycle)
+        self.cycle += 1
+        return self.writing
+
+    def write(self, images: dict, data: np.ndarray, pair: np.ndarray, cycle: int) -> int:
+        if self.archive is None:
+            shades = list(images)
+            self.archive = FrameArchive(self.directory, 'a', shades, images[shades[0]].shape, self.max_squares, self.grow)
+        i = self.archive.append(images, data, pair, cycle)
+        if (i + 1) % self.flush_every == 0:
+            self.archive.flush()
+        return i
+
+    def wait(self):
+        """Waits for the last write, raises its error"""
+        if self.writing is not None:
+            self.writing.result()
+            self.writing = None
+
+    def close(self):
+        self.wait()
+        if self.archive is not None:
+            self.archive.flush()
+        self.writer.shutdown()
+
+
+def cube_row(cube) -> tuple:
+    if cube is None:
+        return 0.0, 0.0, 0.0, NO_ID, NO_ID, ''
+    return float(cube.x), float(cube.y), float(cube.angle), optional_id(cube.id), optional_id(cube.parent_id), \
+        cube.color or ''
@@ -1,9 +1,6 @@
-import os
 from copy import deepcopy
 
-import cv2 as cv
 import numpy as np
-from scipy.optimize import least_squares
 
 from .objects import Cube
 from .image import capture_images
@@ -44,12 +41,11 @@ def calibrate(commander: Commander, camera, calib_config: dict, camera_config: d
         move_cube(commander, p0, p1, motion_config['off_screen_position'], center_dest=False)
 
         # Capture images
-        capture_images(camera, camera_config['img_directory'], camera_config)
-        image_path = os.path.join(camera_config['img_directory'], 'dark.png')
-        image = cv.imread(image_path)
+        images = capture_images(camera, camera_config['img_directory'], camera_config)
+        image = images['dark'].copy()
 
         # Detect squares
-        squares = detect_squares(camera_config['img_directory'], detection_cfg)
+        squares = detect_squares(images, detection_cfg)
 
         if len(squares) == 1:
             camera_coords.append([squares[0].x, squares[0].y])
@@ -86,6 +82,9 @@ def optimized_func(x, cam, glob):
 
 
 def get_transform_parameters(X, Y):
+    # scipy is slow to import and only needed at the end of the calibration
+    from scipy.optimize import least_squares
+
     x0 = [1, 0, 0, 1, 0, 0]
     x = least_squares(optimized_func, x0, args=(X, Y)).x
     a11, a21, a12, a22, b1, b2 = x
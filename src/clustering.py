@@ -0,0 +1,79 @@
+from collections import defaultdict
+
+import numpy as np
+
+
+class GridClustering:
+    """Drop-in replacement of sklearn DBSCAN for square corner vectors.
+    The vectors of shape (N, 2k) are corners of k-gons. If two vectors are closer than eps,
+    their centroids are closer than eps / sqrt(k), so the neighbours are searched only in the adjacent
+    cells of a spatial hash of the centroids and verified with the exact distance of the vectors.
+    The labels are the same as the labels_ of DBSCAN(eps, min_samples).fit(X).
+    """
+
+    def __init__(self, eps: float = 3, min_samples: int = 1):
+        self.eps = eps
+        self.min_samples = min_samples
+        self.labels_ = None
+
+    def fit(self, X: np.ndarray):
+        X = np.asarray(X, dtype=np.float64)
+        n = len(X)
+
+        i, j = self.radius_neighbours(X)
+        is_core = np.bincount(i, minlength=n) >= self.min_samples
+
+        # Connected components of the core points, each one is labeled by its smallest index
+        core_edges = is_core[i] & is_core[j]
+        ci, cj = i[core_edges], j[core_edges]
+        components = np.arange(n)
+        while True:
+            updated = components.copy()
+            np.minimum.at(updated, ci, components[cj])
+            updated = updated[updated]
+            if np.array_equal(updated, components):
+                break
+            components = updated
+
+        # DBSCAN numbers the clusters in the order of their first core point
+        labels = np.full(n, -1, dtype=int)
+        roots = np.flatnonzero(is_core & (components == np.arange(n)))
+        cluster = np.full(n, -1, dtype=int)
+        cluster[roots] = np.arange(len(roots))
+        labels[is_core] = cluster[components[is_core]]
+
+        # Border points belong to the first cluster that reaches them
+        border_edges = ~is_core[i] & is_core[j]
+        if np.any(border_edges):
+            bi, bj = i[border_edges], j[border_edges]
+            first = np.full(n, len(roots), dtype=int)
+            np.minimum.at(first, bi, labels[bj])
+            is_border = first < len(roots)
+            labels[is_border] = first[is_border]
+
+        self.labels_ = labels
+        return self
+
+    def radius_neighbours(self, X: np.ndarray) -> tuple:
+        """Finds all pairs of vectors within eps (including each vector with itself)
+        :param X: vectors with shape (N, 2k)
+        :return: arrays of the first and the second index of the pairs
+        """
+        n, k = len(X), X.shape[1] // 2
+        centroids = X.reshape(n, k, 2).mean(axis=1)
+        keys = np.floor(centroids / (self.eps / np.sqrt(k))).astype(int)
+
+        grid = defaultdict(list)
+        for index, (x, y) in enumerate(keys.tolist()):
+            grid[(x, y)].append(index)
+
+        pairs_i, pairs_j = [np.empty(0, dtype=int)], [np.empty(0, dtype=int)]
+        for (x, y), members in grid.items():
+            members = np.array(members)
+            candidates = np.array([c for dx in (-1, 0, 1) for dy in (-1, 0, 1) for c in grid.get((x + dx, y + dy), ())])
+
+            d = X[members][:, None, :] - X[candidates][None, :, :]
+            m, c = np.nonzero(np.einsum('ijk,ijk->ij', d, d) <= self.eps * self.eps)
+            pairs_i.append(members[m])
+            pairs_j.append(candidates[c])
+        return np.concatenate(pairs_i), np.concatenate(pairs_j)
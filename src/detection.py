@@ -1,12 +1,19 @@
 import os
+import asyncio
+import functools
 import itertools
+from collections import defaultdict
 from copy import deepcopy
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import cv2 as cv
 import numpy as np
-from sklearn.cluster import DBSCAN
 
-from .objects import ApproxPolygon, Square
+from .objects import Square
+from .clustering import GridClustering
+from .thresholds import ThresholdSchedule
+from .instrumentation import instrumented
 
 MAX_COS = 0.06
 MAX_LEN_RATIO = 1.06
@@ -15,17 +22,88 @@ STEP = 1
 MIN_THRESHOLD = 0
 MAX_THRESHOLD = 255
 
+MIN_AREA = 1000
+MAX_AREA = 100000
+
+DEDUP_QUANTUM = 1
+
 DB_EPSILON = 3
 DB_MIN_SAMPLES = 1
 
+SUPPRESSION_CELL = 64
+
+SHADES = ('dark', 'light')
+
+# Pre-filter parameters in pixels, they are scaled with the image in the coarse-to-fine detection
+SPATIAL_PARAMS = ('d', 'sigma_space', 'shadow_radius', 'highlight_radius', 'sigma_s', 'radius')
+SUBPIX_CRITERIA = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+
+# Pre-filter chain used when the configuration does not declare one, see prefilter_chains in detection.yaml
+DEFAULT_PREFILTER = {
+    'dark': [
+        {'type': 'correction', 'shadow_amount_percent': 0.2, 'shadow_tone_percent': 0.2, 'shadow_radius': 3,
+         'highlight_amount_percent': 0.2, 'highlight_tone_percent': 0.2, 'highlight_radius': 3, 'color_percent': 0.6},
+        {'type': 'bilateral', 'd': 30, 'sigma_color': 5, 'sigma_space': 5},
+        {'type': 'bilateral', 'd': 30, 'sigma_color': 10, 'sigma_space': 10},
+        {'type': 'bilateral', 'd': 30, 'sigma_color': 20, 'sigma_space': 20},
+        {'type': 'bilateral', 'd': 30, 'sigma_color': 30, 'sigma_space': 30},
+        {'type': 'bilateral', 'd': 20, 'sigma_color': 40, 'sigma_space': 40},
+    ],
+    'light': [
+        {'type': 'correction', 'shadow_amount_percent': 0.3, 'shadow_tone_percent': 0.3, 'shadow_radius': 7,
+         'highlight_amount_percent': 0.1, 'highlight_tone_percent': 0.1, 'highlight_radius': 3, 'color_percent': 0.6},
+        {'type': 'bilateral', 'd': 10, 'sigma_color': 5, 'sigma_space': 5},
+        {'type': 'bilateral', 'd': 20, 'sigma_color': 10, 'sigma_space': 10},
+        {'type': 'bilateral', 'd': 20, 'sigma_color': 20, 'sigma_space': 20},
+    ],
+}
+
+_executor = None
+_schedule = None
+
+
+def describe_detection(args, kwargs, result) -> dict:
+    return {'squares': len(result)}
 
-def detect_squares(directory: str, config: dict):
-    # Find contours
-    dark_contours, dark_image, light_contours, light_image = find_contours(directory, MIN_THRESHOLD, MAX_THRESHOLD, STEP)
+
+@instrumented(describe_detection)
+def detect_squares(directory, config: dict):
+    """Detects the squares in the dark and light image
+    :param directory: directory containing images of the cubes or dictionary of images keyed by shade,
+                      e.g. the output of capture_images
+    :param config: detection configuration
+    """
+    # The adaptive engine learns from the previous frames, so it always runs in this process
+    engine = config.get('engine', 'sweep')
+    if engine == 'adaptive':
+        images = load_images(directory)
+        return [square for shade in SHADES if shade in images for square in detect_shade(images[shade], shade, config)]
+
+    if config.get('pyramid', {}).get('scale', 1) < 1:
+        return detect_squares_pyramid(directory, config)
+
+    workers = config.get('workers', 1)
+    if workers > 1:
+        return detect_squares_parallel(directory, config, workers)
+
+    # Find square candidates
+    prefilter = prefilter_chain(config)
+    if engine == 'sweep':
+        # The contours are counted for the instrumentation record, they are not kept
+        dark_candidates, dark_image, light_candidates, light_image = find_candidates(directory, MIN_THRESHOLD,
+                                                                                     MAX_THRESHOLD, STEP, prefilter,
+                                                                                     stats={})
+    elif engine == 'component_tree':
+        dark_candidates, dark_image, light_candidates, light_image = find_stable_regions(directory,
+                                                                                         config['component_tree'],
+                                                                                         prefilter, stats={})
+    else:
+        raise ValueError(f'Unknown detection engine: {engine}')
 
     # Create Square objects
-    dark_squares = squares_from_contours(dark_contours, dark_image, mode='min')
-    light_squares = squares_from_contours(light_contours, light_image, mode='min')
+    method = config.get('clustering', 'grid')
+    dark_squares = squares_from_candidates(*dark_candidates, mode='min', method=method)
+    light_squares = squares_from_candidates(*light_candidates, mode='min', method=method)
 
     # for square in dark_squares:
     #     cv.drawContours(dark_image, [square.corners], 0, (0, 255, 0), 2)
@@ -40,131 +118,918 @@ def detect_squares(directory: str, config: dict):
     return dark_squares + light_squares
 
 
-def squares_from_contours(contours_list: list, image,mode: str = 'min') -> list:
+def detect_squares_parallel(directory, config: dict, workers: int):
+    """Same as detect_squares, but the work is fanned out to a pool of processes.
+    Both shades are filtered in parallel, then the threshold sweeps of all six (shade, channel)
+    pairs run in parallel and finally the post-processing of both shades. The results are
+    collected in submission order, so the output is identical to the serial detect_squares.
+    The pre-filter chain of a shade is a single task and the dark one takes most of the time, and OpenCV
+    already runs the filters on all cores, so the pool only shortens the threshold sweeps and needs cores
+    to spare. See benchmark/parallel_detection.py, with one core it is slower than detect_squares.
+    :param directory: directory containing images of the cubes or dictionary of images keyed by shade
+    :param config: detection configuration
+    :param workers: number of worker processes
+    """
+    executor = get_executor(workers)
+
+    images = load_images(directory)
+    shades = [shade for shade in SHADES if shade in images]
+
+    # Filter the images
+    filtered = list(executor.map(preprocess, [images[shade] for shade in shades], shades,
+                                 repeat(prefilter_chain(config))))
+
+    # Find square candidates in every channel of every shade
+    channels = [channel for image in filtered for channel in cv.split(image)]
+    candidates = list(executor.map(channel_candidates, channels, repeat(config)))
+
+    # Create Square objects and find color of each square
+    candidates = [merge_candidates(candidates[3 * i:3 * i + 3]) for i in range(len(shades))]
+    squares = executor.map(shade_squares, candidates, [images[shade] for shade in shades], repeat(config), shades)
+
+    return [square for shade_squares_list in squares for square in shade_squares_list]
+
+
+def detect_squares_pyramid(directory, config: dict) -> list:
+    """Coarse-to-fine form of detect_squares. The squares are first found in the images downscaled by the
+    pyramid 'scale', with the area limits and the spatial parameters of the pre-filters scaled to it.
+    Then only the regions around the coarse squares are detected at full resolution, so the areas and the
+    ids are the same as from detect_squares, and the corners of the squares are refined to sub-pixel
+    precision, which gives their centers and angles.
+    :param directory: directory containing images of the cubes or dictionary of images keyed by shade
+    :param config: detection configuration
+    """
+    images = load_images(directory)
+    return [square for shade in SHADES if shade in images
+            for square in detect_shade_pyramid(images[shade], shade, config)]
+
+
+def detect_shade_pyramid(image: np.ndarray, shade: str, config: dict) -> list:
+    """Coarse-to-fine detection of the squares of one shade, see detect_squares_pyramid
+    :param image: BGR image taken with the gain of the shade
+    :param shade: 'dark' or 'light'
+    :param config: detection configuration
+    """
+    params = config['pyramid']
+    scale, margin = params['scale'], params.get('margin', 48)
+    prefilter = prefilter_chain(config)
+    method = config.get('clustering', 'grid')
+    height, width = image.shape[:2]
+
+    # Coarse squares
+    small = cv.resize(image, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+    filtered = preprocess(small, shade, scale_prefilter(prefilter, scale))
+    candidates = merge_candidates([threshold_candidates(channel, MIN_THRESHOLD, MAX_THRESHOLD, STEP,
+                                                        MIN_AREA * scale ** 2, MAX_AREA * scale ** 2)
+                                   for channel in cv.split(filtered)])
+    coarse = squares_from_candidates(*candidates, mode='min', method=method)
+
+    # Full resolution squares in the regions of the coarse squares
+    rects = []
+    for square in coarse:
+        (x0, y0), (x1, y1) = square.corners.min(axis=0) / scale, square.corners.max(axis=0) / scale
+        rects.append((max(int(x0) - margin, 0), max(int(y0) - margin, 0),
+                      min(int(x1) + margin, width), min(int(y1) + margin, height)))
+
+    gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    squares = []
+    for x0, y0, x1, y1 in merge_rects(rects):
+        filtered = preprocess(image[y0:y1, x0:x1], shade, prefilter)
+        candidates = merge_candidates([threshold_candidates(channel, MIN_THRESHOLD, MAX_THRESHOLD, STEP)
+                                       for channel in cv.split(filtered)])
+        for square in squares_from_candidates(*candidates, mode='min', method=method):
+            square.translate(x0, y0)
+            if not touches_crop_edge(square, (x0, y0, x1, y1), (height, width)):
+                corners = refine_corners(gray, square.corners, params.get('window', 5))
+                squares.append(Square(corners, area=square.area))
+
+    return assign_attributes(squares, image, config, shade)
+
+
+def touches_crop_edge(square: Square, rect: tuple, shape: tuple) -> bool:
+    """Checks if the square lies on an edge of an image crop that is not an edge of the whole image.
+    Such squares are artifacts of the crop, e.g. the whole crop above a threshold.
+    :param square: square in the coordinates of the whole image
+    :param rect: (x0, y0, x1, y1) of the crop
+    :param shape: (height, width) of the whole image
+    """
+    x0, y0, x1, y1 = rect
+    lower = np.array([x0 + 1 if x0 > 0 else -1, y0 + 1 if y0 > 0 else -1])
+    upper = np.array([x1 - 2 if x1 < shape[1] else shape[1], y1 - 2 if y1 < shape[0] else shape[0]])
+    return not (np.all(square.corners > lower) and np.all(square.corners < upper))
+
+
+def merge_rects(rects: list) -> list:
+    """Merges overlapping rectangles until no two of them overlap
+    :param rects: list of (x0, y0, x1, y1) rectangles
+    """
+    rects = list(rects)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            for j in range(i + 1, len(rects)):
+                a, b = rects[i], rects[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    rects[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    del rects[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return rects
+
+
+def refine_corners(gray: np.ndarray, corners: np.ndarray, window: int) -> np.ndarray:
+    """Refines the corners of a square with cv.cornerSubPix, corners that move out of the window are kept
+    :param gray: full resolution grayscale image
+    :param corners: approximate corners with shape (4, 2)
+    :param window: half size of the search window [px]
+    :return: refined corners with shape (4, 1, 2), float32
+    """
+    initial = np.asarray(corners, dtype=np.float32).reshape(-1, 1, 2)
+    refined = cv.cornerSubPix(gray, initial.copy(), (window, window), (-1, -1), SUBPIX_CRITERIA)
+    moved = np.abs(refined - initial).max(axis=2) > window
+    refined[moved] = initial[moved]
+    return refined
+
+
+def scale_prefilter(prefilter: dict, scale: float) -> dict:
+    """Scales the spatial parameters of the pre-filter stages to an image downscaled by the scale
+    :param prefilter: pre-filter chain of each shade
+    :param scale: scale of the image
+    """
+    def scaled(key, value):
+        if key not in SPATIAL_PARAMS:
+            return value
+        return max(1, int(round(value * scale))) if isinstance(value, int) else value * scale
+
+    return {shade: [{key: scaled(key, value) for key, value in stage.items()} for stage in stages]
+            for shade, stages in prefilter.items()}
+
+
+def iter_squares(directory, config: dict):
+    """Generator form of detect_squares, yields the squares of each shade as soon as the shade is processed,
+    so that the consumer can work on the first shade while the other one is still being detected.
+    The squares are the same as from detect_squares, the order of the shades may differ with workers > 1.
+    Like in detect_squares, the adaptive and the coarse-to-fine detection run in the calling process.
+    :param directory: directory containing images of the cubes or dictionary of images keyed by shade
+    :param config: detection configuration
+    :return: generator of lists of squares, one list per shade
+    """
+    images = load_images(directory)
+    workers = config.get('workers', 1)
+    serial = config.get('engine', 'sweep') == 'adaptive' or config.get('pyramid', {}).get('scale', 1) < 1
+    if workers > 1 and not serial:
+        yield from iter_squares_parallel(images, config, workers)
+    else:
+        for shade in SHADES:
+            if shade in images:
+                yield detect_shade(images[shade], shade, config)
+
+
+async def iter_squares_async(directory, config: dict):
+    """Asynchronous form of iter_squares, the detection runs in the default executor of the event loop
+    :param directory: directory containing images of the cubes or dictionary of images keyed by shade
+    :param config: detection configuration
+    :return: asynchronous generator of lists of squares, one list per shade
+    """
+    loop = asyncio.get_running_loop()
+    batches = iter_squares(directory, config)
+    while True:
+        squares = await loop.run_in_executor(None, next, batches, None)
+        if squares is None:
+            return
+        yield squares
+
+
+def detect_shade(image: np.ndarray, shade: str, config: dict) -> list:
+    """Detects the squares of one shade in the calling process
+    :param image: BGR image taken with the gain of the shade
+    :param shade: 'dark' or 'light'
+    :param config: detection configuration
+    """
+    adaptive = config.get('engine', 'sweep') == 'adaptive'
+    if not adaptive and config.get('pyramid', {}).get('scale', 1) < 1:
+        return detect_shade_pyramid(image, shade, config)
+
+    filtered = preprocess(image, shade, prefilter_chain(config))
+    if adaptive:
+        return adaptive_shade_squares(cv.split(filtered), image, config, shade)
+
+    candidates = merge_candidates([channel_candidates(channel, config) for channel in cv.split(filtered)])
+    return shade_squares(candidates, image, config, shade)
+
+
+def adaptive_shade_squares(channels: list, image: np.ndarray, config: dict, shade: str) -> list:
+    """Sweeps only the threshold levels chosen by the threshold schedule. If that finds fewer squares
+    than the previous frame, or there is no previous frame, the full sweep is run instead.
+    Either way the schedule learns the levels at which the detected squares were found.
+    :param channels: channels of the filtered image
+    :param image: BGR image of the shade
+    :param config: detection configuration
+    :param shade: 'dark' or 'light'
+    """
+    schedule = get_schedule(config)
+    keys = [(shade, i, channel.shape) for i, channel in enumerate(channels)]
+
+    squares = None
+    if all(schedule.has_history(key) for key in keys):
+        sweeps = [level_candidates(channel, schedule.levels(channel, key, MIN_THRESHOLD, MAX_THRESHOLD),
+                                   return_levels=True)
+                  for channel, key in zip(channels, keys)]
+        squares = shade_squares(merge_candidates([(vectors, counts) for vectors, counts, _ in sweeps]), image,
+                                config, shade)
+        if len(squares) < schedule.expected_squares(keys[0]):
+            squares = None
+
+    if squares is None:
+        levels = range(MIN_THRESHOLD, MAX_THRESHOLD, STEP)
+        sweeps = [level_candidates(channel, levels, return_levels=True) for channel in channels]
+        squares = shade_squares(merge_candidates([(vectors, counts) for vectors, counts, _ in sweeps]), image,
+                                config, shade)
+
+    # A level contributed if a candidate found at it lies on a detected square
+    centers = np.array([[square.x, square.y] for square in squares], dtype=float).reshape(-1, 1, 2)
+    for key, (vectors, _, candidate_levels) in zip(keys, sweeps):
+        centroids = vectors.reshape(1, -1, 4, 2).mean(axis=2)
+        on_square = np.any(np.abs(centroids - centers).max(axis=2) <= DB_EPSILON, axis=0)
+        contributed = np.zeros(256, dtype=bool)
+        contributed[candidate_levels[on_square]] = True
+        schedule.learn(key, contributed)
+    schedule.update_squares(keys[0], len(squares))
+    return squares
+
+
+def get_schedule(config: dict) -> ThresholdSchedule:
+    """Returns the threshold schedule of the adaptive engine, it is kept between calls"""
+    global _schedule
+    if _schedule is None:
+        _schedule = ThresholdSchedule(config.get('adaptive', {}))
+    return _schedule
+
+
+def iter_squares_parallel(images: dict, config: dict, workers: int):
+    """Same stages as detect_squares_parallel, but each shade moves on to its next stage as soon as
+    its previous stage is finished and its squares are yielded as soon as they are ready
+    :param images: dictionary of images keyed by shade
+    :param config: detection configuration
+    :param workers: number of worker processes
+    """
+    executor = get_executor(workers)
+    prefilter = prefilter_chain(config)
+
+    # Every pending future is mapped to its stage, shade and channel index
+    pending = {executor.submit(preprocess, images[shade], shade, prefilter): ('filter', shade, None)
+               for shade in SHADES if shade in images}
+    candidates = {}
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            stage, shade, index = pending.pop(future)
+            if stage == 'filter':
+                channels = cv.split(future.result())
+                candidates[shade] = [None] * len(channels)
+                for i, channel in enumerate(channels):
+                    pending[executor.submit(channel_candidates, channel, config)] = ('channel', shade, i)
+            elif stage == 'channel':
+                candidates[shade][index] = future.result()
+                if all(c is not None for c in candidates[shade]):
+                    # The channels are merged in their order, so the squares do not depend on the completion order
+                    future = executor.submit(shade_squares, merge_candidates(candidates.pop(shade)), images[shade],
+                                             config, shade)
+                    pending[future] = ('squares', shade, None)
+            else:
+                yield future.result()
+
+
+def get_executor(workers: int) -> ProcessPoolExecutor:
+    """Returns a process pool with the given number of workers. The pool is reused between calls."""
+    global _executor
+    if _executor is None or _executor[0] != workers:
+        if _executor is not None:
+            _executor[1].shutdown()
+        _executor = (workers, ProcessPoolExecutor(max_workers=workers))
+    return _executor[1]
+
+
+def channel_candidates(channel: np.ndarray, config: dict) -> tuple:
+    """Finds contours in a single filtered channel and keeps only the square ones
+    :param channel: single channel of the filtered image
+    :param config: detection configuration
+    :return: unique square corner vectors with shape (N, 8) and their multiplicities
+    """
+    engine = config.get('engine', 'sweep')
+    if engine == 'sweep':
+        return threshold_candidates(channel, MIN_THRESHOLD, MAX_THRESHOLD, STEP)
+    elif engine == 'component_tree':
+        return stable_region_candidates(channel, config['component_tree'])
+    else:
+        raise ValueError(f'Unknown detection engine: {engine}')
+
+
+def shade_squares(candidates: tuple, image: np.ndarray, config: dict, shade: str) -> list:
+    """Creates Square objects from the square candidates of one shade and assigns their attributes"""
+    vectors, counts = candidates
+    squares = squares_from_candidates(vectors, counts, mode='min', method=config.get('clustering', 'grid'))
+    return assign_attributes(squares, image, config, shade)
+
+
+def squares_from_candidates(vectors: np.ndarray, counts: np.ndarray = None, mode: str = 'min',
+                            method: str = 'grid') -> list:
+    """Clusters the square candidates and creates one Square object per cluster
+    :param vectors: square corner vectors with shape (N, 8)
+    :param counts: multiplicity of each vector, i.e. how many contours it was found in (default 1)
+    :param mode: which square of the cluster represents it, 'min', 'max', 'mean' (weighted by the
+                 multiplicities) or 'stable' (the most frequent one)
+    :param method: clustering method, 'grid' or 'dbscan'
+    """
+    if counts is None:
+        counts = np.ones(len(vectors), dtype=int)
+
+    labels = cluster_candidates(vectors, method=method)
+    squares = representative_squares(vectors, counts, labels, mode)
+    return suppress_nested_squares(squares)
+
+
+def representative_squares(vectors: np.ndarray, counts: np.ndarray, labels: np.ndarray, mode: str = 'min') -> list:
+    """Creates one Square object per cluster of square candidates
+    :param vectors: square corner vectors with shape (N, 8)
+    :param counts: multiplicity of each vector
+    :param labels: cluster label of each vector, -1 for noise
+    :param mode: which square of the cluster represents it, see squares_from_candidates
+    """
     squares = []
-    labels, vectors = cluster_square_contours(contours_list)
     contours = vectors.reshape(-1, 4, 1, 2)
+    areas = polygon_areas(vectors.reshape(-1, 4, 2))
+
+    # Members of each cluster in their original order
+    order = np.argsort(labels, kind='stable')
+    bounds = np.searchsorted(labels[order], np.arange(np.max(labels, initial=-1) + 2))
 
     # Create Square objects
-    for i in range(np.max(labels) + 1):
-        tmp = contours[labels == i]
-        min_idx = np.argmin([cv.contourArea(c) for c in tmp])
-        max_idx = np.argmax([cv.contourArea(c) for c in tmp])
-        mean = np.mean(contours[labels == i], axis=0, dtype=np.int32)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        members = order[start:end]
         if mode == 'min':
-            squares.append(Square(tmp[min_idx]))
+            best = members[np.argmin(areas[members])]
+            squares.append(Square(contours[best], area=float(areas[best])))
         elif mode == 'max':
-            squares.append(Square(tmp[max_idx]))
+            best = members[np.argmax(areas[members])]
+            squares.append(Square(contours[best], area=float(areas[best])))
         elif mode == 'mean':
-            squares.append(Square(mean))
+            weights = counts[members]
+            mean = np.sum(contours[members] * weights.reshape(-1, 1, 1, 1), axis=0) / np.sum(weights)
+            squares.append(Square(mean.astype(np.int32)))
+        elif mode == 'stable':
+            best = members[np.argmax(counts[members])]
+            squares.append(Square(contours[best], area=float(areas[best])))
         else:
             raise ValueError('Invalid mode')
 
-    for s1, s2 in itertools.combinations(squares, 2):
-        if s1.is_inside((s2.x, s2.y)) or s2.is_inside((s1.x, s1.y)):
-            if s1 > s2:
-                s1.outer_square = True
-            else:
-                s2.outer_square = True
+    return squares
+
+
+def describe_suppression(args, kwargs, result) -> dict:
+    return {'squares_in': len(args[0]), 'squares': len(result), 'suppressed': len(args[0]) - len(result)}
+
+
+@instrumented(describe_suppression)
+def suppress_nested_squares(squares: list, cell_size: int = SUPPRESSION_CELL) -> list:
+    """Removes the outer square of every pair where one square contains the center of the other.
+    The centers are hashed into a grid, so each square is tested only against the centers inside
+    its bounding box instead of against all other squares.
+    :param squares: list of Square objects
+    :param cell_size: size of the grid cells [px]
+    :return: squares that do not contain any other square, in the original order
+    """
+    grid = defaultdict(list)
+    for index, square in enumerate(squares):
+        grid[(square.x // cell_size, square.y // cell_size)].append(index)
+
+    for i, square in enumerate(squares):
+        x_min, y_min = square.corners.min(axis=0) // cell_size
+        x_max, y_max = square.corners.max(axis=0) // cell_size
+        for cell in itertools.product(range(x_min, x_max + 1), range(y_min, y_max + 1)):
+            for j in grid.get(cell, ()):
+                if i != j and square.is_inside((squares[j].x, squares[j].y)):
+                    # Same rule as the pairwise comparison, the later square is the outer one on equal areas
+                    first, second = squares[min(i, j)], squares[max(i, j)]
+                    if first > second:
+                        first.outer_square = True
+                    else:
+                        second.outer_square = True
 
     return [square for square in squares if not square.outer_square]
 
 
-def find_contours(directory: str, lower: int, upper: int, step: int):
-    """Finds contours in the given images
-    :param directory: directory containing images of the cubes
+def describe_shade_candidates(args, kwargs, result) -> dict:
+    (dark_vectors, _), _, (light_vectors, _), _ = result
+    record = {'candidates': len(dark_vectors) + len(light_vectors), 'bytes': dark_vectors.nbytes + light_vectors.nbytes}
+    if kwargs.get('stats') is not None:
+        record['contours'] = kwargs['stats'].get('contours', 0)
+    return record
+
+
+@instrumented(describe_shade_candidates)
+def find_candidates(directory, lower: int, upper: int, step: int, prefilter: dict = None, stats: dict = None):
+    """Finds the square candidates in the given images. The contours of each threshold are filtered right
+    away, so the memory does not grow with the number of thresholds.
+    :param directory: directory containing images of the cubes or dictionary of images keyed by shade
+    :param lower: Lower threshold
+    :param upper: Upper threshold
+    :param step: Step size for threshold
+    :param prefilter: pre-filter chain of each shade (default DEFAULT_PREFILTER)
+    :param stats: if given, the number of contours of both images is added to stats['contours']
+    :return: (vectors, counts) of the dark image, dark image, (vectors, counts) of the light image, light image
+    """
+    empty = (np.empty((0, 8), dtype=np.int32), np.empty(0, dtype=int))
+    dark_candidates, light_candidates = empty, empty
+    dark_image, light_image = None, None
+    for shade, image, filtered in preprocessed_images(directory, prefilter):
+        candidates = merge_candidates([threshold_candidates(channel, lower, upper, step, stats=stats)
+                                       for channel in cv.split(filtered)])
+
+        if shade == 'dark':
+            dark_candidates, dark_image = candidates, image
+        else:
+            light_candidates, light_image = candidates, image
+
+    return dark_candidates, dark_image, light_candidates, light_image
+
+
+def threshold_candidates(channel: np.ndarray, lower: int, upper: int, step: int, min_area: float = MIN_AREA,
+                         max_area: float = MAX_AREA, quantum: int = DEDUP_QUANTUM, stats: dict = None) -> tuple:
+    """Thresholds the channel at every level from lower to upper and finds the square candidates, see level_candidates
+    :param channel: single channel of the filtered image
     :param lower: Lower threshold
     :param upper: Upper threshold
     :param step: Step size for threshold
+    :param min_area: minimum area of the square
+    :param max_area: maximum area of the square
+    :param quantum: contour points are compared on a grid of this size, see deduplicate_contours
+    :param stats: if given, the number of contours of all levels is added to stats['contours']
+    :return: unique square corner vectors with shape (N, 8) and their multiplicities
     """
-    dark_contours, light_contours = [], []
+    return level_candidates(channel, range(lower, upper, step), min_area, max_area, quantum, stats)
+
+
+def level_candidates(channel: np.ndarray, levels, min_area: float = MIN_AREA, max_area: float = MAX_AREA,
+                     quantum: int = DEDUP_QUANTUM, stats: dict = None, return_levels: bool = False) -> tuple:
+    """Thresholds the channel at the given levels and finds the square candidates. The contours of each
+    level are turned into square candidates and dropped, only hashes of the contours already seen are
+    kept, so that the duplicates from the neighbouring levels are approximated only once.
+    :param channel: single channel of the filtered image
+    :param levels: threshold levels
+    :param min_area: minimum area of the square
+    :param max_area: maximum area of the square
+    :param quantum: contour points are compared on a grid of this size, see deduplicate_contours
+    :param stats: if given, the number of contours is added to stats['contours']
+    :param return_levels: also return the median level at which each vector was found
+    :return: unique square corner vectors with shape (N, 8) and their multiplicities
+    """
+    contour_count = 0
+    seen = {}  # hash of a contour -> row of its square candidate, -1 if it is not a square
+    rows = {}  # corner vector -> row
+    vectors, counts, vector_levels = [], [], []
+    for level in levels:
+        _, thresh = cv.threshold(channel, int(level), 255, cv.THRESH_BINARY)
+        level_contours, _ = cv.findContours(thresh, cv.RETR_LIST, cv.CHAIN_APPROX_SIMPLE)
+        contour_count += len(level_contours)
+
+        # Contours seen at the previous levels only add to the multiplicity of their candidate
+        pending, new_contours, new_counts = {}, [], []
+        for contour in level_contours:
+            key = hash(contour.tobytes() if quantum == 1 else (contour // quantum).tobytes())
+            row = seen.get(key)
+            if row is not None:
+                if row >= 0:
+                    counts[row] += 1
+                    if return_levels:
+                        vector_levels[row].append(level)
+            elif key in pending:
+                new_counts[pending[key]] += 1
+            else:
+                pending[key] = len(new_contours)
+                new_contours.append(contour)
+                new_counts.append(1)
+
+        keys = list(pending)
+        seen.update(dict.fromkeys(keys, -1))
+        polygons, polygon_counts, sources = square_polygons(new_contours, np.array(new_counts, dtype=int),
+                                                            min_area, max_area)
+        for polygon, count, source in zip(polygons, polygon_counts, sources):
+            vector = polygon.tobytes()
+            row = rows.get(vector)
+            if row is None:
+                row = rows[vector] = len(vectors)
+                vectors.append(polygon.reshape(8))
+                counts.append(0)
+                vector_levels.append([])
+            counts[row] += count
+            if return_levels:
+                vector_levels[row].extend([level] * count)
+            seen[keys[source]] = row
+
+    if stats is not None:
+        stats['contours'] = stats.get('contours', 0) + contour_count
+    candidates = np.array(vectors, dtype=np.int32).reshape(-1, 8), np.array(counts, dtype=int)
+    if return_levels:
+        return candidates + (np.array([np.median(row_levels) for row_levels in vector_levels]).astype(int),)
+    return candidates
+
+
+@instrumented(describe_shade_candidates)
+def find_stable_regions(directory, config: dict, prefilter: dict = None, stats: dict = None):
+    """Finds the square candidates in the given images along the branches of their threshold component trees,
+    see stable_region_candidates
+    :param directory: directory containing images of the cubes or dictionary of images keyed by shade
+    :param config: component tree configuration (delta, max_variation, min_diversity, square_tolerance,
+                   branch_tolerance, margin, patience)
+    :param prefilter: pre-filter chain of each shade (default DEFAULT_PREFILTER)
+    :param stats: if given, the number of contours of both images is added to stats['contours']
+    :return: (vectors, counts) of the dark image, dark image, (vectors, counts) of the light image, light image
+    """
+    empty = (np.empty((0, 8), dtype=np.int32), np.empty(0, dtype=int))
+    dark_candidates, light_candidates = empty, empty
     dark_image, light_image = None, None
+    for shade, image, filtered in preprocessed_images(directory, prefilter):
+        candidates = merge_candidates([stable_region_candidates(channel, config, stats)
+                                       for channel in cv.split(filtered)])
+
+        if shade == 'dark':
+            dark_candidates, dark_image = candidates, image
+        else:
+            light_candidates, light_image = candidates, image
+
+    return dark_candidates, dark_image, light_candidates, light_image
+
+
+def stable_region_candidates(channel: np.ndarray, config: dict, stats: dict = None) -> tuple:
+    """Finds the square candidates of the channel in its threshold component tree.
+    The tree is built once (MSER) and every square-like stable region is followed along its branch: the
+    component of the region is flood-filled at the neighbouring levels, down and up, while it stays
+    square-like, and its contour is traced at each of them. A dark region is the hole of the thresholded
+    image (4-connected), a bright region its foreground (8-connected), so the contours are the ones the
+    sweep of the whole channel finds at the same levels. A branch is left when it reaches a level already
+    visited from another region, the edge of the crop around the region, or after 'patience' levels whose
+    contour is not a quadrilateral. A square whose smallest form lies beyond that is found at a neighbouring
+    level, with a slightly larger area than from the sweep.
+    :param channel: single channel of the filtered image
+    :param config: component tree configuration
+    :param stats: if given, the number of traced contours is added to stats['contours']
+    :return: unique square corner vectors with shape (N, 8) and their multiplicities
+    """
+    mser = cv.MSER_create(config['delta'], MIN_AREA, MAX_AREA, config['max_variation'], config['min_diversity'])
+    regions, boxes = mser.detectRegions(channel)
+    tolerance, branch_tolerance = config.get('square_tolerance', 0.15), config.get('branch_tolerance', 0.3)
+    margin, patience = config.get('margin', 0.5), config.get('patience', 3)
+    height, width = channel.shape
+
+    contours, visited = [], set()
+    for region, (x, y, w, h) in zip(regions, boxes):
+        if not square_like(w, h, len(region), tolerance):
+            continue
+
+        # The pixel left of the leftmost point of the region is outside of it, brighter for a dark region
+        values = channel[region[:, 1], region[:, 0]]
+        left = region[np.argmin(region[:, 0])]
+        if left[0] == 0:
+            continue
+        dark = channel[left[1], left[0] - 1] > values.max()
+        seed = region[np.argmin(values) if dark else np.argmax(values)]
+        start = int(values.max()) if dark else int(values.min()) - 1
+        # The region is the component at its level, the branch was followed already if that was visited
+        if (dark, start, x, y, w, h, len(region)) in visited:
+            continue
+
+        pad = int(max(w, h) * margin) + 2
+        x0, y0, x1, y1 = max(x - pad, 0), max(y - pad, 0), min(x + w + pad, width), min(y + h + pad, height)
+        crop = channel[y0:y1, x0:x1]
+        seed, seed_value = (int(seed[0] - x0), int(seed[1] - y0)), int(channel[seed[1], seed[0]])
+        mask = np.empty((y1 - y0 + 2, x1 - x0 + 2), dtype=np.uint8)
+
+        for levels in (range(start, seed_value - 1, -1), range(start + 1, 255)) if dark else \
+                (range(start, -1, -1), range(start + 1, seed_value)):
+            contour, previous, misses = None, None, 0
+            mask.fill(0)
+            for level in levels:
+                # Fixed range flood fill of the pixels <= level (dark) or > level (bright) connected to the seed
+                lo, up = (seed_value, level - seed_value) if dark else (seed_value - level - 1, 255 - seed_value)
+                flags = (4 if dark else 8) | cv.FLOODFILL_MASK_ONLY | cv.FLOODFILL_FIXED_RANGE | (255 << 8)
+                area, _, _, (bx, by, bw, bh) = cv.floodFill(crop, mask, seed, 0, lo, up, flags)
+                component = mask[by:by + bh + 2, bx:bx + bw + 2]
+
+                # The hole of a dark component encloses more than its pixels, squares of min_area have half of them
+                key = (dark, level, bx + x0, by + y0, bw, bh, area)
+                if key in visited or bx == 0 or by == 0 or bx + bw == x1 - x0 or by + bh == y1 - y0 \
+                        or area < MIN_AREA / 2 or not square_like(bw, bh, area, branch_tolerance):
+                    break
+                visited.add(key)
+
+                # The same component as at the previous level has the same contour
+                if area != previous:
+                    offset = (x0 + bx - 1, y0 + by - 1)
+                    if dark:
+                        holes, hierarchy = cv.findContours(255 - component, cv.RETR_CCOMP, cv.CHAIN_APPROX_SIMPLE,
+                                                           offset=offset)
+                        contour = next(hole for hole, node in zip(holes, hierarchy[0]) if node[3] >= 0)
+                    else:
+                        contour = cv.findContours(component, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE,
+                                                  offset=offset)[0][0]
+                    previous = area
+                    length = cv.arcLength(contour, True)
+                    quadrilateral = len(cv.approxPolyDP(contour, 0.03 * length, True)) == 4
+                misses = 0 if quadrilateral else misses + 1
+                if misses > patience:
+                    break
+                contours.append(contour)
+                # Only the filled component is cleared for the next level
+                component.fill(0)
+
+    if stats is not None:
+        stats['contours'] = stats.get('contours', 0) + len(contours)
+    contours, contour_counts = deduplicate_contours(contours)
+    polygons, counts, _ = square_polygons(contours, contour_counts)
+    return merge_candidates([(polygons.reshape(-1, 8), counts)])
+
+
+def square_like(width: int, height: int, area: int, tolerance: float) -> bool:
+    """Checks if a bounding box fits a square of the area at some rotation, its side is between s (axis-aligned)
+    and sqrt(2) * s (rotated by 45 deg) for the side s
+    :param width: width of the bounding box
+    :param height: height of the bounding box
+    :param area: number of pixels of the region
+    :param tolerance: allowed deviation as a fraction of the side
+    """
+    side = np.sqrt(area)
+    return abs(width - height) <= tolerance * side and (1 - tolerance) * side <= min(width, height) \
+        and max(width, height) <= (np.sqrt(2) + tolerance) * side
+
+
+def preprocessed_images(directory, prefilter: dict = None):
+    """Loads the dark and light images from the directory and filters them for the contour search
+    :param directory: directory containing images of the cubes or dictionary of images keyed by shade
+    :param prefilter: pre-filter chain of each shade (default DEFAULT_PREFILTER)
+    :return: generator of (shade, original image, filtered image)
+    """
+    for shade, img in load_images(directory).items():
+        yield shade, deepcopy(img), preprocess(img, shade, prefilter)
+
+
+def load_images(directory) -> dict:
+    """Loads the dark and light images from the directory
+    :param directory: directory containing images of the cubes, or the images already keyed by shade
+    :return: dictionary of images keyed by shade
+    """
+    if isinstance(directory, dict):
+        return {shade: image for shade, image in directory.items() if shade in SHADES}
+
+    images = {}
     for file in os.scandir(directory):
         file_path = os.path.join(directory, file.name)
-        img = cv.imread(file_path)
 
         if 'dark' in file.name:
-            dark_image = deepcopy(img)
-            img = correction(img, 0.2, 0.2, 3, 0.2, 0.2, 3, 0.6)
-            img = cv.bilateralFilter(img, 30, 5, 5)
-            img = cv.bilateralFilter(img, 30, 10, 10)
-            img = cv.bilateralFilter(img, 30, 20, 20)
-            img = cv.bilateralFilter(img, 30, 30, 30)
-            img = cv.bilateralFilter(img, 20, 40, 40)
+            images['dark'] = cv.imread(file_path)
+        elif 'light' in file.name:
+            images['light'] = cv.imread(file_path)
+    return images
 
-            # cv.imshow('image', img)
-            # cv.waitKey(0)
-            # cv.destroyAllWindows()
 
-            for channel in cv.split(img):
-                for threshold in range(lower, upper, step):
-                    _, thresh = cv.threshold(channel, threshold, 255, cv.THRESH_BINARY)
-                    contours, _ = cv.findContours(thresh, cv.RETR_LIST, cv.CHAIN_APPROX_SIMPLE)
-                    dark_contours.extend(contours)
+def prefilter_chain(config: dict) -> dict:
+    """Returns the pre-filter chain selected in the detection configuration
+    :param config: detection configuration
+    :return: dictionary of lists of pre-filter stages keyed by shade
+    """
+    chains = config.get('prefilter_chains')
+    if chains is None:
+        return DEFAULT_PREFILTER
+    return chains[config.get('prefilter', 'default')]
 
 
-        elif 'light' in file.name:
-            light_image = deepcopy(img)
-            img = correction(img, 0.3, 0.3, 7, 0.1, 0.1, 3, 0.6)
-            img = cv.bilateralFilter(img, 10, 5, 5)
-            img = cv.bilateralFilter(img, 20, 10, 10)
-            img = cv.bilateralFilter(img, 20, 20, 20)
-
-            for channel in cv.split(img):
-                for threshold in range(lower, upper, step):
-                    _, thresh = cv.threshold(channel, threshold, 255, cv.THRESH_BINARY)
-                    contours, _ = cv.findContours(thresh, cv.RETR_LIST, cv.CHAIN_APPROX_SIMPLE)
-                    light_contours.extend(contours)
+def preprocess(img: np.ndarray, shade: str, prefilter: dict = None) -> np.ndarray:
+    """Corrects shadows/highlights and smooths the image while preserving the edges
+    :param img: BGR image
+    :param shade: 'dark' or 'light'
+    :param prefilter: pre-filter chain of each shade (default DEFAULT_PREFILTER),
+                      each stage is a dictionary with the 'type' of the filter and its parameters
+    """
+    if prefilter is None:
+        prefilter = DEFAULT_PREFILTER
 
-        else:
+    for stage in prefilter[shade]:
+        params = {key: value for key, value in stage.items() if key != 'type'}
+        img = PREFILTERS[stage['type']](img, **params)
+
+    # cv.imshow('image', img)
+    # cv.waitKey(0)
+    # cv.destroyAllWindows()
+
+    return img
+
+
+def bilateral_filter(img: np.ndarray, d: int, sigma_color: float, sigma_space: float) -> np.ndarray:
+    return cv.bilateralFilter(img, d, sigma_color, sigma_space)
+
+
+def pyramid_bilateral_filter(img: np.ndarray, scale: float, d: int, sigma_color: float,
+                             sigma_space: float) -> np.ndarray:
+    """Bilateral filter applied on a downscaled image, the result is upscaled back to the original size.
+    :param img: BGR image
+    :param scale: downscaling factor (0, 1]
+    :param d: diameter of the pixel neighborhood at the original resolution
+    :param sigma_color: filter sigma in the color space
+    :param sigma_space: filter sigma in the coordinate space at the original resolution
+    """
+    height, width = img.shape[:2]
+    small = cv.resize(img, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+    small = cv.bilateralFilter(small, max(int(round(d * scale)), 1), sigma_color, sigma_space * scale)
+    return cv.resize(small, (width, height), interpolation=cv.INTER_LINEAR)
+
+
+def edge_preserving_filter(img: np.ndarray, sigma_s: float, sigma_r: float, recursive: bool = True) -> np.ndarray:
+    """Domain transform edge preserving filter (cv.edgePreservingFilter)
+    :param img: BGR image
+    :param sigma_s: size of the neighborhood [0, 200]
+    :param sigma_r: how dissimilar colors are averaged [0, 1]
+    :param recursive: recursive filter if True, normalized convolution filter otherwise
+    """
+    flags = cv.RECURS_FILTER if recursive else cv.NORMCONV_FILTER
+    return cv.edgePreservingFilter(img, flags=flags, sigma_s=sigma_s, sigma_r=sigma_r)
+
+
+def guided_filter(img: np.ndarray, radius: int, eps: float) -> np.ndarray:
+    """Guided filter (He et al.) with each channel used as its own guide, computed with box filters
+    :param img: BGR image
+    :param radius: radius of the box window
+    :param eps: regularization, edges with variance above eps (in 8-bit units squared) are preserved
+    """
+    ksize = (2 * radius + 1, 2 * radius + 1)
+    p = img.astype(np.float32)
+
+    mean = cv.boxFilter(p, -1, ksize)
+    variance = cv.boxFilter(p * p, -1, ksize)
+    variance -= mean * mean
+
+    a = variance / (variance + eps)
+    b = mean - a * mean
+    a = cv.boxFilter(a, -1, ksize)
+    b = cv.boxFilter(b, -1, ksize)
+
+    q = a * p
+    q += b
+    return np.clip(q + .5, 0, 255).astype(np.uint8)
+
+
+def square_polygons(contours: list, contour_counts: np.ndarray, min_area: float = MIN_AREA,
+                    max_area: float = MAX_AREA) -> tuple:
+    """Approximates unique contours by polygons and keeps the squares
+    :param contours: unique contours
+    :param contour_counts: number of occurrences of each contour
+    :param min_area: minimum area of the square
+    :param max_area: maximum area of the square
+    :return: square corners with shape (N, 4, 2), their multiplicities and the index of the contour of each square
+    """
+    polygons, polygon_counts, sources = [], [], []
+    for i, (contour, count) in enumerate(zip(contours, contour_counts)):
+        length = cv.arcLength(contour, True)
+
+        # The polygon can not enclose more than length^2 / (4 * pi), skip contours that are too short
+        if length * length <= 4 * np.pi * min_area:
             continue
 
-    return dark_contours, dark_image, light_contours, light_image
+        polygon = cv.approxPolyDP(contour, 0.03 * length, True)
+        if len(polygon) == 4:
+            polygons.append(polygon)
+            polygon_counts.append(count)
+            sources.append(i)
 
+    polygons = np.array(polygons, dtype=np.int32).reshape(-1, 4, 2)
+    is_square = filter_squares(polygons, min_area, max_area)
+    return polygons[is_square], np.array(polygon_counts, dtype=int)[is_square], np.array(sources, dtype=int)[is_square]
 
-def cluster_square_contours(contours: list, eps: int = DB_EPSILON, min_samples: int = DB_MIN_SAMPLES) -> tuple:
-    """Clusters contours that are squares
-    :param contours: Contours to cluster
-    :param eps: DBSCAN epsilon
-    :param min_samples: DBSCAN min_samples
+
+def deduplicate_contours(contours: list, quantum: int = DEDUP_QUANTUM) -> tuple:
+    """Collapses identical contours, the first occurrence of each contour is kept
+    :param contours: Contours to deduplicate
+    :param quantum: contour points are compared on a grid of this size (1 - only identical contours are collapsed)
+    :return: list of unique contours and the number of occurrences of each of them
     """
-    vectors = []
+    index, unique, counts = {}, [], []
     for contour in contours:
-        poly = ApproxPolygon(contour)
-        if poly.area_in_range(min_area=1000, max_area=100000) and \
-                poly.is_square(max_cos=MAX_COS, max_len_ratio=MAX_LEN_RATIO):
-            vectors.append(poly.polygon.reshape(8, ))
+        key = contour.tobytes() if quantum == 1 else (contour // quantum).tobytes()
+        i = index.get(key)
+        if i is None:
+            index[key] = len(unique)
+            unique.append(contour)
+            counts.append(1)
+        else:
+            counts[i] += 1
+    return unique, np.array(counts, dtype=int)
 
-    vectors = np.array(vectors)
-    clustering = DBSCAN(eps=eps, min_samples=min_samples).fit(vectors)
 
-    return clustering.labels_, vectors
+def merge_candidates(candidates: list) -> tuple:
+    """Merges square candidates and collapses identical corner vectors, their multiplicities are summed.
+    The vectors stay in the order of their first occurrence.
+    :param candidates: list of (vectors, counts) tuples
+    :return: unique square corner vectors with shape (N, 8) and their multiplicities
+    """
+    vectors = np.concatenate([v for v, _ in candidates]).reshape(-1, 8)
+    counts = np.concatenate([c for _, c in candidates]).astype(int)
 
+    unique, first, inverse = np.unique(vectors, axis=0, return_index=True, return_inverse=True)
+    unique_counts = np.bincount(inverse.reshape(-1), weights=counts, minlength=len(unique)).astype(int)
 
-def assign_attributes(squares: list, image: np.ndarray, config: dict, shade: str) -> list:
-    hsv_image = cv.cvtColor(image, cv.COLOR_BGR2HSV)
-    filtered_squares = []
+    order = np.argsort(first)
+    return unique[order], unique_counts[order]
 
-    for square in squares:
-        pixels = []
 
-        for color in config['colors'].values():
-            mask = np.zeros(hsv_image.shape[:2], dtype=np.uint8)
+def filter_squares(polygons: np.ndarray, min_area: float = MIN_AREA, max_area: float = MAX_AREA,
+                   max_cos: float = MAX_COS, max_len_ratio: float = MAX_LEN_RATIO) -> np.ndarray:
+    """Keeps the quadrilaterals that are squares, all of them are tested at once.
+    Vectorized equivalent of ApproxPolygon.area_in_range and ApproxPolygon.is_square.
+    :param polygons: corners of the quadrilaterals with shape (N, 4, 2)
+    :param min_area: minimum area of the square
+    :param max_area: maximum area of the square
+    :param max_cos: maximum cosine of the angle between the sides of the square
+    :param max_len_ratio: maximum ratio between the length of the sides of the square
+    :return: boolean mask of the squares
+    """
+    c = polygons.astype(np.float64)
+    c1, c2 = np.roll(c, 1, axis=1), np.roll(c, 2, axis=1)
+
+    # Side vectors, the sides are c1 -> c and c1 -> c2 for the corner c1
+    d1, d2 = c - c1, c2 - c1
 
+    areas = polygon_areas(polygons)
+    lengths = np.sqrt(np.sum(d1 * d1, axis=2))
+    cross = d1[..., 0] * d2[..., 1] - d1[..., 1] * d2[..., 0]
 
-            cv.drawContours(mask, [square.corners], -1, 255, -1)
-            square_hsv = cv.bitwise_and(hsv_image, hsv_image, mask=mask)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cos_angles = np.abs(np.sum(d1 * d2, axis=2)) / np.sqrt(np.sum(d1 * d1, axis=2) * np.sum(d2 * d2, axis=2))
+        len_ratios = np.max(lengths, axis=1) / np.min(lengths, axis=1)
 
-            lower = np.array(color['lower'])
-            upper = np.array(color['upper'])
+    is_convex = np.all(cross > 0, axis=1) | np.all(cross < 0, axis=1)
+    is_square = (min_area < areas) & (areas < max_area) & is_convex & \
+                (np.max(cos_angles, axis=1) < max_cos) & (len_ratios < max_len_ratio)
+
+    return is_square
+
+
+def polygon_areas(polygons: np.ndarray) -> np.ndarray:
+    """Areas of the polygons (shoelace formula), same as cv.contourArea for each of them
+    :param polygons: corners of the polygons with shape (N, K, 2)
+    """
+    x, y = polygons[..., 0].astype(np.float64), polygons[..., 1].astype(np.float64)
+    return np.abs(np.sum(x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y, axis=1)) / 2
+
+
+def describe_clusters(args, kwargs, result) -> dict:
+    return {'candidates': len(args[0]), 'clusters': int(np.max(result, initial=-1)) + 1}
+
+
+@instrumented(describe_clusters)
+def cluster_candidates(vectors: np.ndarray, eps: int = DB_EPSILON, min_samples: int = DB_MIN_SAMPLES,
+                       method: str = 'grid') -> np.ndarray:
+    """Clusters square corner vectors
+    :param vectors: square corner vectors with shape (N, 8)
+    :param eps: DBSCAN epsilon
+    :param min_samples: DBSCAN min_samples
+    :param method: 'grid' (spatial hash of the square centroids) or 'dbscan' (sklearn reference implementation),
+                   both give the same labels
+    :return: cluster label of each vector
+    """
+    if len(vectors) == 0:
+        return np.empty(0, dtype=int)
 
-            filtered_image = cv.inRange(square_hsv, lower, upper)
-            pixels.append(np.sum(filtered_image))
+    if method == 'grid':
+        clustering = GridClustering(eps=eps, min_samples=min_samples).fit(vectors)
+    elif method == 'dbscan':
+        from sklearn.cluster import DBSCAN
+        clustering = DBSCAN(eps=eps, min_samples=min_samples).fit(vectors)
+    else:
+        raise ValueError(f'Unknown clustering method: {method}')
+    return clustering.labels_
 
-        if config['colors'][np.argmax(pixels)]['shade'] == shade:
-            square.vis_color = config['colors'][np.argmax(pixels)]['rgb']
-            square.symbol = config['colors'][np.argmax(pixels)]['symbol']
-            square.color = config['colors'][np.argmax(pixels)]['color']
+
+def describe_attributes(args, kwargs, result) -> dict:
+    return {'squares_in': len(args[0]), 'squares': len(result), 'shade': args[3] if len(args) > 3 else kwargs['shade']}
+
+
+@instrumented(describe_attributes)
+def assign_attributes(squares: list, image: np.ndarray, config: dict, shade: str) -> list:
+    hsv_image = cv.cvtColor(image, cv.COLOR_BGR2HSV)
+    labels = color_labels(hsv_image, config)
+    colors = list(config['colors'].values())
+    filtered_squares = []
+
+    for square in squares:
+        pixels = color_histogram(labels, square.corners, len(colors))
+        color = colors[np.argmax(pixels)]
+
+        if color['shade'] == shade:
+            square.vis_color = color['rgb']
+            square.symbol = color['symbol']
+            square.color = color['color']
 
             for i, (ub, lb) in enumerate(zip(config['boundaries']['upper'], config['boundaries']['lower'])):
                 if lb < square.area < ub:
@@ -173,9 +1038,59 @@ def assign_attributes(squares: list, image: np.ndarray, config: dict, shade: str
             filtered_squares.append(square)
     return filtered_squares
 
+
+def color_labels(hsv_image: np.ndarray, config: dict) -> np.ndarray:
+    """Classifies every pixel of the image into the colors from the configuration.
+    The colors may overlap, so the label is a bit mask, bit i is set if the pixel is in the range of color i.
+    :param hsv_image: HSV image
+    :param config: detection configuration
+    :return: label image of the same size as the input image
+    """
+    ranges = tuple((tuple(color['lower']), tuple(color['upper'])) for color in config['colors'].values())
+    h_lut, s_lut, v_lut = color_luts(ranges)
+    return h_lut[hsv_image[..., 0]] & s_lut[hsv_image[..., 1]] & v_lut[hsv_image[..., 2]]
+
+
+@functools.lru_cache(maxsize=8)
+def color_luts(ranges: tuple) -> tuple:
+    """Compiles the HSV ranges of the colors into one lookup table per channel.
+    Entry v of the table of a channel has bit i set if v is in the range of color i in that channel,
+    so a pixel is in the range of color i if bit i is set in all three tables.
+    :param ranges: tuple of (lower, upper) HSV bounds of every color
+    """
+    dtype = np.min_scalar_type(2 ** len(ranges) - 1)
+    values = np.arange(256)
+
+    luts = np.zeros((3, 256), dtype=dtype)
+    for i, (lower, upper) in enumerate(ranges):
+        for channel in range(3):
+            in_range = (lower[channel] <= values) & (values <= upper[channel])
+            luts[channel][in_range] |= dtype.type(1 << i)
+    return tuple(luts)
+
+
+def color_histogram(labels: np.ndarray, corners: np.ndarray, n_colors: int) -> list:
+    """Counts the pixels of each color inside the polygon
+    :param labels: label image from color_labels
+    :param corners: corners of the polygon
+    :param n_colors: number of colors
+    """
+    height, width = labels.shape[:2]
+    x, y, w, h = cv.boundingRect(corners)
+    x0, y0, x1, y1 = max(x, 0), max(y, 0), min(x + w, width), min(y + h, height)
+    if x1 <= x0 or y1 <= y0:
+        return [0] * n_colors
+
+    mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    cv.drawContours(mask, [corners - (x0, y0)], -1, 255, -1)
+    square_labels = labels[y0:y1, x0:x1][mask > 0]
+
+    return [np.count_nonzero(square_labels & (1 << i)) for i in range(n_colors)]
+
+
 def correction(img, shadow_amount_percent, shadow_tone_percent, shadow_radius,
                highlight_amount_percent, highlight_tone_percent, highlight_radius,
-               color_percent):
+               color_percent, out=None):
     """
     Image Shadow / Highlight Correction. The same function as it in Photoshop / GIMP
     :param img: input RGB image numpy array of shape (height, width, 3)
@@ -186,6 +1101,7 @@ def correction(img, shadow_amount_percent, shadow_tone_percent, shadow_radius,
     :param highlight_tone_percent [0.0 ~ 1.0]: Controls the range of tones in the shadows or highlights that are modified.
     :param highlight_radius [>0]: Controls the size of the local neighborhood around each pixel
     :param color_percent [-1.0 ~ 1.0]:
+    :param out: optional preallocated uint8 array of shape (height, width, 3) for the result
     :return:
     """
     shadow_tone = shadow_tone_percent * 255
@@ -194,67 +1110,140 @@ def correction(img, shadow_amount_percent, shadow_tone_percent, shadow_radius,
     shadow_gain = 1 + shadow_amount_percent * 6
     highlight_gain = 1 + highlight_amount_percent * 6
 
-    # extract RGB channel
     height, width = img.shape[:2]
-    img = img.astype(np.float)
-    img_R, img_G, img_B = img[..., 2].reshape(-1), img[..., 1].reshape(-1), img[..., 0].reshape(-1)
+    if out is None:
+        out = np.empty((height, width, 3), dtype=np.uint8)
+
+    # The LUT indices and the output are truncated, so the arithmetic is float64 in the order of the formulas in
+    # the comments, the result is bit-identical to them. Only the temporaries are reused in place.
+    img_B, img_G, img_R = (img[..., channel].astype(np.float64) for channel in range(3))
 
     # The entire correction process is carried out in YUV space,
     # adjust highlights/shadows in Y space, and adjust colors in UV space
     # convert to Y channel (grey intensity) and UV channel (color)
-    img_Y = .3 * img_R + .59 * img_G + .11 * img_B
-    img_U = -img_R * .168736 - img_G * .331264 + img_B * .5
-    img_V = img_R * .5 - img_G * .418688 - img_B * .081312
+    # Y = .3 * R + .59 * G + .11 * B
+    img_Y = .3 * img_R
+    img_Y += .59 * img_G
+    img_Y += .11 * img_B
+    # U = -R * .168736 - G * .331264 + B * .5
+    img_U = img_R * -.168736
+    img_U -= img_G * .331264
+    img_U += img_B * .5
+    # V = R * .5 - G * .418688 - B * .081312
+    img_V = img_R * .5
+    img_V -= img_G * .418688
+    img_V -= img_B * .081312
+    del img_R, img_G, img_B
 
     # extract shadow / highlight
-    shadow_map = 255 - img_Y * 255 / shadow_tone
-    shadow_map[np.where(img_Y >= shadow_tone)] = 0
-    highlight_map = 255 - (255 - img_Y) * 255 / (255 - highlight_tone)
-    highlight_map[np.where(img_Y <= highlight_tone)] = 0
+    # shadow_map = 255 - Y * 255 / shadow_tone
+    shadow_map = img_Y * 255
+    shadow_map /= shadow_tone
+    np.subtract(255, shadow_map, out=shadow_map)
+    shadow_map[img_Y >= shadow_tone] = 0
+    # highlight_map = 255 - (255 - Y) * 255 / (255 - highlight_tone)
+    highlight_map = 255 - img_Y
+    highlight_map *= 255
+    highlight_map /= 255 - highlight_tone
+    np.subtract(255, highlight_map, out=highlight_map)
+    highlight_map[img_Y <= highlight_tone] = 0
 
     # // Gaussian blur on tone map, for smoother transition
     if shadow_amount_percent * shadow_radius > 0:
-        # shadow_map = cv2.GaussianBlur(shadow_map.reshape(height, width), ksize=(shadow_radius, shadow_radius), sigmaX=0).reshape(-1)
-        shadow_map = cv.blur(shadow_map.reshape(height, width), ksize=(shadow_radius, shadow_radius)).reshape(-1)
+        shadow_map = cv.blur(shadow_map, ksize=(shadow_radius, shadow_radius))
 
     if highlight_amount_percent * highlight_radius > 0:
-        # highlight_map = cv2.GaussianBlur(highlight_map.reshape(height, width), ksize=(highlight_radius, highlight_radius), sigmaX=0).reshape(-1)
-        highlight_map = cv.blur(highlight_map.reshape(height, width), ksize=(highlight_radius, highlight_radius)).reshape(-1)
+        highlight_map = cv.blur(highlight_map, ksize=(highlight_radius, highlight_radius))
 
     # Tone LUT
+    LUT_shadow, LUT_highlight = tone_luts(shadow_gain, highlight_gain)
+
+    # adjust tone
+    shadow_map *= 1 / 255
+    highlight_map *= 1 / 255
+
+    # iH = (1 - shadow_map) * Y + shadow_map * LUT_shadow[int(Y)], Y and iH are not negative
+    iH = 1 - shadow_map
+    iH *= img_Y
+    lut = cv.LUT(img_Y.astype(np.uint8), LUT_shadow)
+    lut *= shadow_map
+    iH += lut
+
+    # Y = (1 - highlight_map) * iH + highlight_map * LUT_highlight[int(iH)]
+    np.subtract(1, highlight_map, out=img_Y)
+    img_Y *= iH
+    lut = cv.LUT(iH.astype(np.uint8), LUT_highlight, dst=lut)
+    lut *= highlight_map
+    img_Y += lut
+    del iH, lut
+
+    # adjust color
+    if color_percent != 0:
+        # adjust color saturation adaptively according to highlights/shadows
+        # color_gain = LUT[int(U ** 2 + V ** 2 + .5)]
+        radius = img_U * img_U
+        radius += img_V * img_V
+        radius += .5
+        color_gain = color_lut(color_percent)[radius.astype(np.int32)]
+        del radius
+
+        # w = 1 - min(2 - (shadow_map + highlight_map), 1)
+        w = shadow_map
+        w += highlight_map
+        np.subtract(2, w, out=w)
+        np.minimum(w, 1, out=w)
+        np.subtract(1, w, out=w)
+
+        # UV = w * UV + (1 - w) * UV * color_gain
+        keep = 1 - w
+        for uv in (img_U, img_V):
+            gained = keep * uv
+            gained *= color_gain
+            uv *= w
+            uv += gained
+        del keep, gained, color_gain
+
+    # re convert to RGB channel, values above 255 are saturated
+    # B = Y + 1.772 * U, G = Y - .34414 * U - .71414 * V, R = Y + 1.402 * V, each + .5 and truncated
+    for channel, (u, v) in enumerate(((1.772, 0), (-.34414, -.71414), (0, 1.402))):
+        value = img_Y.copy()
+        if u:
+            value += u * img_U
+        if v:
+            value += v * img_V
+        value += .5
+        value = value.astype(np.int32)
+        np.minimum(value, 255, out=value)
+        out[..., channel] = value
+
+    return out
+
+
+@functools.lru_cache(maxsize=8)
+def tone_luts(shadow_gain: float, highlight_gain: float) -> tuple:
+    """Shadow and highlight tone lookup tables of the correction"""
     t = np.arange(256)
     LUT_shadow = (1 - np.power(1 - t * (1 / 255), shadow_gain)) * 255
     LUT_shadow = np.maximum(0, np.minimum(255, np.int_(LUT_shadow + .5)))
     LUT_highlight = np.power(t * (1 / 255), highlight_gain) * 255
     LUT_highlight = np.maximum(0, np.minimum(255, np.int_(LUT_highlight + .5)))
+    return LUT_shadow.astype(np.float64), LUT_highlight.astype(np.float64)
 
-    # adjust tone
-    shadow_map = shadow_map * (1 / 255)
-    highlight_map = highlight_map * (1 / 255)
 
-    iH = (1 - shadow_map) * img_Y + shadow_map * LUT_shadow[np.int_(img_Y)]
-    iH = (1 - highlight_map) * iH + highlight_map * LUT_highlight[np.int_(iH)]
-    img_Y = iH
+@functools.lru_cache(maxsize=8)
+def color_lut(color_percent: float) -> np.ndarray:
+    """Color saturation lookup table of the correction, indexed by U^2 + V^2"""
+    if color_percent > 0:
+        LUT = (1 - np.sqrt(np.arange(32768)) * (1 / 128)) * color_percent + 1
+    else:
+        LUT = np.sqrt(np.arange(32768)) * (1 / 128) * color_percent + 1
+    return LUT
 
-    # adjust color
-    if color_percent != 0:
-        # color LUT
-        if color_percent > 0:
-            LUT = (1 - np.sqrt(np.arange(32768)) * (1 / 128)) * color_percent + 1
-        else:
-            LUT = np.sqrt(np.arange(32768)) * (1 / 128) * color_percent + 1
 
-        # adjust color saturation adaptively according to highlights/shadows
-        color_gain = LUT[np.int_(img_U ** 2 + img_V ** 2 + .5)]
-        w = 1 - np.minimum(2 - (shadow_map + highlight_map), 1)
-        img_U = w * img_U + (1 - w) * img_U * color_gain
-        img_V = w * img_V + (1 - w) * img_V * color_gain
-
-    # re convert to RGB channel
-    output_R = np.int_(img_Y + 1.402 * img_V + .5)
-    output_G = np.int_(img_Y - .34414 * img_U - .71414 * img_V + .5)
-    output_B = np.int_(img_Y + 1.772 * img_U + .5)
-
-    output = np.row_stack([output_B, output_G, output_R]).T.reshape(height, width, 3)
-    output = np.minimum(output, 255).astype(np.uint8)
-    return output
+PREFILTERS = {
+    'correction': correction,
+    'bilateral': bilateral_filter,
+    'pyramid_bilateral': pyramid_bilateral_filter,
+    'edge_preserving': edge_preserving_filter,
+    'guided': guided_filter,
+}
@@ -1,24 +1,38 @@
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2 as cv
-import numpy as np
 
 try:
     import PyCapture2
 except ImportError:
+    # Only the replay camera can be used, it defines the constants of PyCapture2
     print('PyCapture2 not found')
+    from . import replay as PyCapture2
+
+from .acquisition import CameraStream, FramePool, frame_view
+from .replay import ReplayCamera
+
+_writer = None
+_saving = None
+_pool = FramePool()
 
 
 def set_up_camera(config: dict):
-    """Sets up the camera and returns a camera object
+    """Sets up the camera and returns a camera object, or a CameraStream acquiring its frames
+    in the background if 'stream' is enabled in the configuration. If 'replay' is enabled, the camera
+    replays recorded frame sets instead of connecting to the physical camera.
     :param config: Configuration file
     """
 
     # Connect to the camera
-    bus = PyCapture2.BusManager()
-    camera = PyCapture2.Camera()
-    camera.connect(bus.getCameraFromIndex(0))
+    if config.get('replay', {}).get('enabled', False):
+        camera = ReplayCamera(config)
+    else:
+        bus = PyCapture2.BusManager()
+        camera = PyCapture2.Camera()
+        camera.connect(bus.getCameraFromIndex(0))
     camera.startCapture()
 
     # Set the camera settings
@@ -29,18 +43,33 @@ def set_up_camera(config: dict):
     camera.setProperty(type=PyCapture2.PROPERTY_TYPE.GAIN, absValue=settings['gain'], autoManualMode=False)
     camera.setProperty(type=PyCapture2.PROPERTY_TYPE.BRIGHTNESS, absValue=settings['brightness'], autoManualMode=False)
 
+    if config.get('stream', {}).get('enabled', False):
+        return CameraStream(camera, config)
     return camera
 
 
-def capture_images(camera, directory: str, config: dict):
-    """Captures images from the camera and saves them to the given directory
-    :param camera: Camera object
-    :param directory: Directory to save the images to
+def capture_images(camera, directory: str, config: dict) -> dict:
+    """Captures images from the camera and returns them keyed by color of the gain setting.
+    If a directory is given and 'save_images' is enabled in the configuration, the images are also
+    saved to it in the background.
+    :param camera: Camera object or CameraStream
+    :param directory: Directory to save the images to, or None to keep them only in memory
     :param config: Configuration file
+    :return: dictionary of BGR images keyed by color, their buffers are reused after two further captures
     """
-    os.makedirs(directory, exist_ok=True)
+    global _saving
+    if _saving is not None:
+        # The buffers of the pool must not be overwritten while the background save still reads them
+        _saving.result()
+        _saving = None
 
+    images = {}
     for color, value in config['gain'].items():
+        if isinstance(camera, CameraStream):
+            # The stream returns the first frame taken with the new gain, converted in its thread
+            images[color] = camera.capture(value)
+            continue
+
         # Set the gain to the value for the current color
         camera.setProperty(type=PyCapture2.PROPERTY_TYPE.GAIN, absValue=value)
         time.sleep(0.3)
@@ -49,7 +78,31 @@ def capture_images(camera, directory: str, config: dict):
         image = camera.retrieveBuffer()
         image = image.convert(PyCapture2.PIXEL_FORMAT.BGR)
 
-        # Convert the image to a numpy array
-        cv_image = np.array(image.getData(), dtype="uint8").reshape((image.getRows(), image.getCols(), 3))
-        image_path = os.path.join(directory, f'{color}.png')
-        cv.imwrite(image_path, cv_image)
+        # Copy the camera buffer directly to a preallocated array
+        images[color] = _pool.store(color, frame_view(image))
+
+    if directory is not None and config.get('save_images', True):
+        _saving = save_images_async(images, directory)
+    return images
+
+
+def save_images_async(images: dict, directory: str):
+    """Saves the images to the directory in a background thread, the images must not be modified afterwards
+    :param images: dictionary of images keyed by color
+    :param directory: Directory to save the images to
+    :return: future of the save
+    """
+    global _writer
+    if _writer is None:
+        _writer = ThreadPoolExecutor(max_workers=1)
+    return _writer.submit(save_images, images, directory)
+
+
+def save_images(images: dict, directory: str):
+    """Saves the images to the directory as <color>.png
+    :param images: dictionary of images keyed by color
+    :param directory: Directory to save the images to
+    """
+    os.makedirs(directory, exist_ok=True)
+    for color, image in images.items():
+        cv.imwrite(os.path.join(directory, f'{color}.png'), image)
@@ -0,0 +1,117 @@
+import cv2 as cv
+import numpy as np
+
+from .detection import detect_squares, load_images, merge_rects, touches_crop_edge, SHADES
+
+CROP_ALIGN = 8
+
+
+class IncrementalDetector:
+    """Detects squares only in the parts of the scene that changed since the previous frames.
+    The new frames are compared with the previous ones, the changed pixels are grouped into regions
+    and the detection runs only on crops around those regions. Squares outside the regions are carried
+    over from the previous detection, including their parent_id. Every 'full_every'-th call, on the first
+    call and when too much of the scene changed, the whole frames are detected again.
+    """
+
+    def __init__(self, config: dict):
+        """
+        :param config: detection configuration, the 'incremental' section sets the parameters
+        """
+        self.config = config
+        params = config.get('incremental', {})
+        self.diff_threshold = params.get('diff_threshold', 30)
+        self.min_changed_area = params.get('min_changed_area', 100)
+        self.max_changed_fraction = params.get('max_changed_fraction', 0.3)
+        self.margin = params.get('margin', 100)
+        self.full_every = params.get('full_every', 10)
+
+        self.frames = None
+        self.squares = []
+        self.cycles = 0
+
+    def detect(self, images) -> list:
+        """Detects the squares in the dark and light image
+        :param images: directory containing images of the cubes or dictionary of images keyed by shade
+        :return: list of squares
+        """
+        images = load_images(images)
+        regions = None
+        if self.frames is not None and self.cycles % self.full_every != 0 and self.same_shape(images):
+            regions = self.changed_regions(images)
+
+        if regions is None:
+            squares = detect_squares(images, self.config)
+        else:
+            squares = self.detect_regions(images, regions)
+
+        self.store_frames(images)
+        self.squares = squares
+        self.cycles += 1
+        return squares
+
+    def reset(self):
+        """Forces a full detection on the next call"""
+        self.frames = None
+        self.cycles = 0
+
+    def same_shape(self, images: dict) -> bool:
+        return all(shade in images and images[shade].shape == self.frames[shade].shape for shade in self.frames)
+
+    def changed_regions(self, images: dict):
+        """Finds the rectangles of the scene that changed since the previous frames
+        :return: list of (x0, y0, x1, y1) rectangles, or None if the whole scene should be detected again
+        """
+        changed = None
+        for shade, frame in self.frames.items():
+            diff = cv.absdiff(images[shade], frame).max(axis=2) > self.diff_threshold
+            changed = diff if changed is None else changed | diff
+
+        # Remove the sensor noise before grouping the pixels
+        changed = cv.morphologyEx(changed.astype(np.uint8), cv.MORPH_OPEN, np.ones((5, 5), np.uint8))
+        if np.count_nonzero(changed) > self.max_changed_fraction * changed.size:
+            return None
+
+        n, _, stats, _ = cv.connectedComponentsWithStats(changed)
+        rects = [(int(x), int(y), int(x + w), int(y + h)) for x, y, w, h, area in stats[1:n] if area >= self.min_changed_area]
+
+        # A square touched by a change is detected again as a whole
+        for square in self.squares:
+            (x0, y0), (x1, y1) = square.corners.min(axis=0), square.corners.max(axis=0)
+            for i, rect in enumerate(rects):
+                if x0 < rect[2] and rect[0] < x1 and y0 < rect[3] and rect[1] < y1:
+                    rects[i] = (min(int(x0), rect[0]), min(int(y0), rect[1]), max(int(x1), rect[2]), max(int(y1), rect[3]))
+
+        return merge_rects(rects)
+
+    def detect_regions(self, images: dict, regions: list) -> list:
+        """Carries over the squares outside the regions and detects the squares inside them"""
+        def inside(square, rect):
+            return rect[0] <= square.x < rect[2] and rect[1] <= square.y < rect[3]
+
+        squares = [square for square in self.squares if not any(inside(square, rect) for rect in regions)]
+
+        height, width = next(iter(images.values())).shape[:2]
+        for rect in regions:
+            # The margin gives the pre-filters context and keeps the squares at the region border whole,
+            # the crop is aligned so that the downscaling pre-filters sample the same pixels as on the whole frame
+            x0 = max(rect[0] - self.margin, 0) // CROP_ALIGN * CROP_ALIGN
+            y0 = max(rect[1] - self.margin, 0) // CROP_ALIGN * CROP_ALIGN
+            x1, y1 = min(rect[2] + self.margin, width), min(rect[3] + self.margin, height)
+            crops = {shade: image[y0:y1, x0:x1] for shade, image in images.items()}
+
+            for square in detect_squares(crops, self.config):
+                square.translate(x0, y0)
+                if inside(square, rect) and not touches_crop_edge(square, (x0, y0, x1, y1), (height, width)):
+                    squares.append(square)
+
+        return squares
+
+    def store_frames(self, images: dict):
+        """Keeps a copy of the frames, the caller may reuse its buffers"""
+        if self.frames is None or not self.same_shape(images):
+            self.frames = {shade: images[shade].copy() for shade in SHADES if shade in images}
+        else:
+            for shade, frame in self.frames.items():
+                np.copyto(frame, images[shade])
+
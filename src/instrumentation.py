@@ -0,0 +1,100 @@
+import json
+import time
+import functools
+from contextlib import contextmanager
+
+import numpy as np
+
+# Callables that receive every record, the instrumentation is enabled while there is at least one
+_sinks = []
+_depth = 0
+
+
+def instrumented(describe=None, stage: str = None):
+    """Decorator that records every call of the function while the instrumentation is enabled.
+    A record is a dictionary with the stage name, the call depth, the start time and the duration,
+    and the fields returned by describe(args, kwargs, result), e.g. the numbers of contours or
+    squares and the sizes of the allocated arrays. When it is disabled, the call costs one check.
+    :param describe: function returning a dictionary of additional fields of the record
+    :param stage: name of the stage (default the name of the function)
+    """
+    def decorator(func):
+        name = stage or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return func(*args, **kwargs)
+
+            global _depth
+            _depth += 1
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                _depth -= 1
+            record = {'stage': name, 'depth': _depth, 'start': start, 'time': time.perf_counter() - start}
+            if describe is not None:
+                record.update(describe(args, kwargs, result))
+            emit(record)
+            return result
+        return wrapper
+    return decorator
+
+
+def emit(record: dict):
+    for sink in list(_sinks):
+        sink(record)
+
+
+def add_sink(sink):
+    """Enables the instrumentation, the sink is called with every record"""
+    _sinks.append(sink)
+
+
+def remove_sink(sink):
+    _sinks.remove(sink)
+
+
+def is_enabled() -> bool:
+    return bool(_sinks)
+
+
+@contextmanager
+def collect():
+    """Collects the records of the calls made inside the block
+    :return: list that is filled with the records
+    """
+    records = []
+    add_sink(records.append)
+    try:
+        yield records
+    finally:
+        remove_sink(records.append)
+
+
+def record_to_jsonl(path: str):
+    """Appends every record as a line of JSON to the file until stop_recording is called
+    :param path: path of the JSONL file
+    :return: the sink, to be passed to stop_recording
+    """
+    file = open(path, 'a')
+
+    def sink(record):
+        file.write(json.dumps(record, default=json_default) + '\n')
+        file.flush()
+
+    sink.file = file
+    add_sink(sink)
+    return sink
+
+
+def stop_recording(sink):
+    remove_sink(sink)
+    sink.file.close()
+
+
+def json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
@@ -1,4 +1,6 @@
+import time
 import numpy as np
+import cv2 as cv
 from copy import copy
 
 from .objects import Cube
@@ -6,8 +8,12 @@ from .robCRSgripper import robCRSgripper
 from .interpolation import interpolate_poly, interpolate_p_spline, interpolate_b_spline
 
 
-def move_cube(commander, c0: Cube, c1: Cube, off_screen_pos: list, center_dest: bool = True):
-    """ Moves the cube from c0 to c1. """
+def move_cube(commander, c0: Cube, c1: Cube, off_screen_pos: list, center_dest: bool = True,
+              view: np.ndarray = None, view_margin: float = 0):
+    """ Moves the cube from c0 to c1.
+    If the camera view is given, returns as soon as the arm has left it on the way to the off-screen position,
+    the images can be captured while the arm is still moving.
+    """
     # Center cubes
     if center_dest:
         c1 = center_cube(commander, c1, release=True)
@@ -39,7 +45,10 @@ def move_cube(commander, c0: Cube, c1: Cube, off_screen_pos: list, center_dest:
     commander.wait_gripper_ready()
     
     # Move to the off-screen position
-    move(commander, c1.operational_level, off_screen_pos, step=3)
+    if view is None:
+        move(commander, c1.operational_level, off_screen_pos, step=3)
+    else:
+        leave_view(commander, c1.operational_level, off_screen_pos, view, view_margin, step=3)
 
 
 def center_cube(commander, c: Cube, release: bool = False):
@@ -78,7 +87,7 @@ def center_cube(commander, c: Cube, release: bool = False):
     return c
 
 
-def move_spline(trajectory, commander, spline, order):
+def move_spline(trajectory, commander, spline, order, wait=True):
     spline_params = []
 
     if spline == 'poly':
@@ -97,10 +106,12 @@ def move_spline(trajectory, commander, spline, order):
     commander.wait_ready(sync=True)
     for i in range(len(spline_params)):
         commander.splinemv(spline_params[i], order=order)
-    commander.wait_ready(sync=True)
+    if wait:
+        commander.wait_ready(sync=True)
 
 
-def move(commander, x0, x1, step=3):
+def line_points(x0, x1, step=3) -> list:
+    """Positions along the straight line from x0 to x1, 'step' apart, or None if the points are the same"""
     x0 = np.array(x0, dtype=object)
     x1 = np.array(x1, dtype=object)
     rng = int(np.linalg.norm(x0 - x1) / step)
@@ -108,29 +119,117 @@ def move(commander, x0, x1, step=3):
         normal = (x1 - x0) / np.linalg.norm(x0 - x1)
     except Exception:
         return None
-    x = x0
-    sol = [commander.find_closest_ikt(x)]
+    points = [x0]
     for _ in range(rng):
-        x = x + normal * step
-        prev_x = commander.find_closest_ikt(x, sol[-1])
-        sol.append(prev_x)
-
-    sol.append(commander.find_closest_ikt(x1, sol[-1]))
+        points.append(points[-1] + normal * step)
+    points.append(x1)
+    return points
+
+
+def move(commander, x0, x1, step=3, wait=True):
+    """Moves along the straight line from x0 to x1
+    :param wait: wait until the motion is finished, otherwise return when it is sent to the control unit
+    :return: planned joint trajectory in IRC, one position per point of the line, or None
+    """
+    points = line_points(x0, x1, step)
+    if points is None:
+        return None
+    sol = [commander.find_closest_ikt(points[0])]
+    for x in points[1:]:
+        sol.append(commander.find_closest_ikt(x, sol[-1]))
     sol = np.array(sol)
 
     try:
-        move_spline(sol, commander, 'b-spline', 2)
-        return
+        move_spline(sol, commander, 'b-spline', 2, wait)
+        return sol
     except Exception:
         print('Not enough points for b-spline order 2')
     
     try:
-        move_spline(sol, commander, 'poly', 2)
-        return
+        move_spline(sol, commander, 'poly', 2, wait)
+        return sol
     except Exception:
         print('Not enough points for polynomial order 1')
+        return None
+
+
+def camera_view(A: np.ndarray, b: np.ndarray, image_shape: tuple) -> np.ndarray:
+    """Polygon of the area seen by the camera in the robot coordinates (x, y)
+    :param A: camera to robot transformation matrix
+    :param b: camera to robot transformation vector
+    :param image_shape: shape of the camera images
+    """
+    height, width = image_shape[:2]
+    corners = np.array([[0, width, width, 0], [0, 0, height, height]])
+    return (A @ corners + b).T.astype(np.float32)
+
+
+def leave_view(commander, x0, x1, view: np.ndarray, margin: float = 0, step=3, period=0.05, timeout=30):
+    """Moves along the straight line from x0 to x1 and returns as soon as the arm has left the camera view
+    for the rest of the line, the motion continues. The time is found from the planned trajectory: the
+    position of the joints is compared with the planned positions until the first one after which the whole
+    arm is outside the view is passed. The arm is checked at the points along its links, from the shoulder
+    to the tip of the gripper (see arm_points), seen from above. The links are lines through the joints,
+    their width and the perspective of the camera, which sees the high parts of the arm farther from the
+    image center, are not modelled, the margin has to cover them.
+    :param view: polygon of the camera view in the robot coordinates, see camera_view
+    :param margin: distance from the view every point of the arm must have [mm]
+    :param period: period of the position queries [s]
+    :param timeout: maximum wait, after it the end of the motion is awaited [s]
+    """
+    trajectory = move(commander, x0, x1, step, wait=False)
+    if trajectory is None:
+        commander.wait_ready(sync=True)
+        return
+
+    # First planned position after which the arm stays outside of the view
+    angles = np.atleast_2d(commander.irctoangles(trajectory))
+    inside = [any(cv.pointPolygonTest(view, (float(p[0]), float(p[1])), True) > -margin
+                  for p in arm_points(commander.robot, a)) for a in angles]
+    clear = len(inside) - inside[::-1].index(True) if True in inside else 0
+    if clear >= len(trajectory):
+        commander.wait_ready(sync=True)
         return
 
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        _, position = commander.axis_get_pos()
+        if np.argmin(np.linalg.norm(trajectory - position, axis=1)) >= clear:
+            return
+        time.sleep(period)
+    commander.wait_ready(sync=True)
+
+
+def arm_points(robot, pos, spacing: float = 20) -> np.ndarray:
+    """Points along the links of the arm from the shoulder to the tip of the gripper, the joints are found
+    with the same transformations as in robCRSdkt
+    :param robot: CRS robot instance
+    :param pos: Coordinates of robot position in joint coordinates (degrees)
+    :param spacing: maximum distance of the points on a link [mm]
+    :return: points in world coordinates with shape (N, 3)
+    """
+    T = np.eye(4)
+    pos = np.array(pos) / 180.0 * np.pi
+    joints = []
+    for i in range(6):
+        o = -robot.offset[i] + pos[i]
+        a = robot.alpha[i]
+        rz = np.eye(4)
+        rz[:2, :2] = [[np.cos(o), -np.sin(o)], [np.sin(o), np.cos(o)]]
+        rz[2, 3] = robot.d[i]
+        rx = np.eye(4)
+        rx[1:3, 1:3] = [[np.cos(a), -np.sin(a)], [np.sin(a), np.cos(a)]]
+        rx[0, 3] = robot.a[i]
+        T = T.dot(rz).dot(rx)
+        joints.append(T[:3, 3])
+
+    points = [joints[0]]
+    for p0, p1 in zip(joints, joints[1:]):
+        n = max(int(np.ceil(np.linalg.norm(p1 - p0) / spacing)), 1)
+        points.extend(p0 + (p1 - p0) * k / n for k in range(1, n + 1))
+    return np.array(points)
+
+
 def is_reachable(commander, c: Cube):
     try:
         commander.find_closest_ikt(c.cube_level)
@@ -1,12 +1,25 @@
+from typing import NamedTuple
+
 import cv2 as cv
 import numpy as np
 
+COLOR_DTYPE = 'U8'
+SQUARE_DTYPE = np.dtype([('x', np.int32), ('y', np.int32), ('area', np.float64), ('angle', np.float64),
+                         ('width', np.int32), ('height', np.int32), ('id', np.int16), ('parent_id', np.int16),
+                         ('color', COLOR_DTYPE), ('corners', np.int32, (4, 2))])
+CUBE_DTYPE = np.dtype([('x', np.float64), ('y', np.float64), ('angle', np.float64), ('id', np.int16),
+                       ('parent_id', np.int16), ('color', COLOR_DTYPE)])
+
+# Missing id or parent id in the structured arrays
+NO_ID = -1
+
 
 class ApproxPolygon:
     """Approximate polygon for a square detection in the image.
     The object approximates the contour of the square and calculates its area.
     Its functionality is to determine whether the contour is a square or not.
     """
+    __slots__ = ('length', 'polygon', 'area')
 
     def __init__(self, contour: np.ndarray):
         self.length = cv.arcLength(contour, True)
@@ -43,8 +56,10 @@ class Square:
     The object contains information about the square's position, color, and ID (size information).
     It can be used to create a Cube object or for visualization.
     """
+    __slots__ = ('id', 'color', 'symbol', 'vis_color', 'corners', 'x', 'y', 'area', 'angle', 'width', 'height',
+                 'outer_square', 'parent_id')
 
-    def __init__(self, contour: np.ndarray, vis_color=None):
+    def __init__(self, contour: np.ndarray, vis_color=None, area: float = None):
         self.id = None
         self.color = None
         self.symbol = None
@@ -57,7 +72,7 @@ class Square:
 
         self.x = int(x)
         self.y = int(y)
-        self.area = cv.contourArea(contour)
+        self.area = cv.contourArea(contour) if area is None else area
         self.angle = -angle
         self.width = int(w)
         self.height = int(h)
@@ -65,10 +80,29 @@ class Square:
         self.outer_square = None
         self.parent_id = None
 
+    @classmethod
+    def from_row(cls, row: np.void):
+        """Restores a square from a row of a SquareSet array, without fitting the rectangle again"""
+        square = cls.__new__(cls)
+        square.x, square.y = int(row['x']), int(row['y'])
+        square.area, square.angle = float(row['area']), float(row['angle'])
+        square.width, square.height = int(row['width']), int(row['height'])
+        square.corners = np.array(row['corners'], dtype=int)
+        square.id, square.parent_id = none_id(row['id']), none_id(row['parent_id'])
+        square.color = str(row['color']) or None
+        square.symbol, square.vis_color, square.outer_square = None, None, None
+        return square
+
     def is_inside(self, point: tuple):
         point = tuple(map(float, point))
         return cv.pointPolygonTest(self.corners, point, False) > 0
 
+    def translate(self, dx: int, dy: int):
+        """Moves the square by the given offset, e.g. from the coordinates of an image crop to the whole image"""
+        self.x += int(dx)
+        self.y += int(dy)
+        self.corners = self.corners + (dx, dy)
+
     def create_cube(self, A: np.ndarray, b: np.ndarray, motion_config: dict):
         camera_coords = np.array([[self.x], [self.y]])
         global_coords = A @ camera_coords + b
@@ -99,70 +133,82 @@ class Square:
         return out
 
 
+class MotionLevels(NamedTuple):
+    """Heights and offsets of the cube poses from the motion configuration"""
+    cube_level: float
+    operational_level: float
+    transport_level: float
+    release_level: tuple
+    release_x_offset: float
+    release_angle_offset: float
+    pre_release_angle_offset: float
+    grip_power: float
+
+    @classmethod
+    def from_config(cls, config: dict):
+        return cls(config['cube_level'], config['operational_level'], config['transport_level'],
+                   tuple(config['release_level']), config['release_x_offset'], config['release_angle_offset'],
+                   config['pre_release_angle_offset'], config['grip_power'])
+
+
 class Cube:
     """Object representing a cube in the global coordinate system.
     The object contains information about the cube's position, color, and ID (size information).
     The object is generated from a Square object. Its attributes are used for a motion planning.
     """
+    __slots__ = ('x', 'y', 'id', 'angle', 'color', 'levels', 'grip_power', 'parent_id')
 
-    def __init__(self, x: int, y: int, angle: int, size_id: int, parent_id: int, config: dict, color: str = None):
+    def __init__(self, x: int, y: int, angle: int, size_id: int, parent_id: int, config, color: str = None):
+        """
+        :param config: motion configuration or its MotionLevels, which can be shared by many cubes
+        """
         self.x = x
         self.y = y
         self.id = size_id
         self.angle = angle
         self.color = color
-        self.config = config
-        self.grip_power = self.config['grip_power']
+        self.levels = config if isinstance(config, MotionLevels) else MotionLevels.from_config(config)
+        self.grip_power = self.levels.grip_power
         self.parent_id = parent_id
 
     @property
     def cube_level(self) -> tuple:
-        z = self.config['cube_level']
-        return self.x, self.y, z, self.angle, 90, 0
+        return self.x, self.y, self.levels.cube_level, self.angle, 90, 0
 
     @property
     def cube_level_rot(self) -> tuple:
-        z = self.config['cube_level']
-        return self.x, self.y, z, self.angle + 90, 90, 0
+        return self.x, self.y, self.levels.cube_level, self.angle + 90, 90, 0
 
     @property
     def operational_level(self) -> tuple:
-        z = self.config['operational_level']
-        return self.x, self.y, z, self.angle, 90, 0
+        return self.x, self.y, self.levels.operational_level, self.angle, 90, 0
 
     @property
     def operational_level_rot(self) -> tuple:
-        z = self.config['operational_level']
-        return self.x, self.y, z, self.angle + 90, 90, 0
+        return self.x, self.y, self.levels.operational_level, self.angle + 90, 90, 0
 
     @property
     def transport_level(self) -> tuple:
-        z = self.config['transport_level']
-        return self.x, self.y, z, self.angle, 90, 0
+        return self.x, self.y, self.levels.transport_level, self.angle, 90, 0
 
     @property
     def transport_level_rot(self) -> tuple:
-        z = self.config['transport_level']
-        return self.x, self.y, z, self.angle + 90, 90, 0
+        return self.x, self.y, self.levels.transport_level, self.angle + 90, 90, 0
 
     @property
     def pre_release_level(self) -> tuple:
-        z = self.config['release_level'][self.parent_id]
-        angle_offset = self.config['pre_release_angle_offset']
-        return self.x, self.y, z, self.angle, 90 + angle_offset, 0
+        levels = self.levels
+        return self.x, self.y, levels.release_level[self.parent_id], self.angle, 90 + levels.pre_release_angle_offset, 0
 
     @property
     def release_level(self) -> tuple:
-        z = self.config['release_level'][self.parent_id]
-        angle_offset = self.config['release_angle_offset']
-        x_offset = self.config['release_x_offset']
-        return self.x + x_offset, self.y, z, self.angle, 90 + angle_offset, 0
+        levels = self.levels
+        return (self.x + levels.release_x_offset, self.y, levels.release_level[self.parent_id], self.angle,
+                90 + levels.release_angle_offset, 0)
 
     @property
     def post_release_cube_level(self) -> tuple:
-        z = self.config['cube_level']
-        x_offset = self.config['release_x_offset']
-        return self.x + x_offset, self.y, z, self.angle, 90, 0
+        return self.x + self.levels.release_x_offset, self.y, self.levels.cube_level, self.angle, 90, 0
 
     def is_reachable(self, commander) -> bool:
         try:
@@ -202,3 +248,106 @@ class Cube:
                 \tAngle: {self.angle}\n\n \
                 \tParent id: {self.parent_id}\n\n'
         return out
+
+
+class SquareSet:
+    """Columnar set of squares backed by a structured array (SQUARE_DTYPE) for bulk operations.
+    The Square objects are kept as well, indexing with an integer and iterating returns them.
+    Missing ids are NO_ID and missing colors are empty strings in the array.
+    """
+    __slots__ = ('data', 'squares')
+
+    def __init__(self, squares=()):
+        self.squares = list(squares)
+        self.data = np.array([(s.x, s.y, s.area, s.angle, s.width, s.height, optional_id(s.id), optional_id(s.parent_id),
+                               s.color or '', s.corners) for s in self.squares], dtype=SQUARE_DTYPE)
+
+    @classmethod
+    def from_rows(cls, data: np.ndarray, squares: list):
+        square_set = cls.__new__(cls)
+        square_set.data, square_set.squares = data, squares
+        return square_set
+
+    @classmethod
+    def from_data(cls, data: np.ndarray):
+        """Creates the set and its Square objects from a SQUARE_DTYPE array, e.g. read from an archive"""
+        return cls.from_rows(data, [Square.from_row(row) for row in data])
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.squares)
+
+    def __getitem__(self, index):
+        """Integer index returns the Square, a slice, an index array or a boolean mask returns a SquareSet"""
+        if isinstance(index, (int, np.integer)):
+            return self.squares[index]
+        rows = np.arange(len(self.data))[index]
+        return self.from_rows(self.data[rows], [self.squares[i] for i in rows])
+
+    def identified(self) -> 'SquareSet':
+        return self[(self.data['id'] != NO_ID) & (self.data['color'] != '')]
+
+    def sorted(self, key: str = 'area', reverse: bool = False) -> 'SquareSet':
+        order = np.argsort(self.data[key], kind='stable')
+        return self[order[::-1] if reverse else order]
+
+    def to_cubes(self, A: np.ndarray, b: np.ndarray, motion_config) -> 'CubeSet':
+        """Transforms all squares to the global coordinate system at once, see Square.create_cube"""
+        global_coords = A @ np.stack([self.data['x'], self.data['y']]) + b
+        data = np.empty(len(self.data), dtype=CUBE_DTYPE)
+        data['x'], data['y'] = global_coords[0], global_coords[1]
+        for field in ('angle', 'id', 'parent_id', 'color'):
+            data[field] = self.data[field]
+        return CubeSet(data, motion_config)
+
+
+class CubeSet:
+    """Columnar set of cubes backed by a structured array (CUBE_DTYPE) for bulk operations.
+    Indexing with an integer and iterating creates Cube objects from the rows, changes of those
+    objects are not written back to the set.
+    """
+    __slots__ = ('data', 'levels')
+
+    def __init__(self, data: np.ndarray, motion_config):
+        self.data = data
+        self.levels = motion_config if isinstance(motion_config, MotionLevels) else MotionLevels.from_config(motion_config)
+
+    @classmethod
+    def from_cubes(cls, cubes: list, motion_config):
+        data = np.array([(c.x, c.y, c.angle, optional_id(c.id), optional_id(c.parent_id), c.color or '')
+                         for c in cubes], dtype=CUBE_DTYPE)
+        return cls(data, motion_config)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return (self.cube(i) for i in range(len(self.data)))
+
+    def __getitem__(self, index):
+        """Integer index returns a Cube, a slice, an index array or a boolean mask returns a CubeSet"""
+        if isinstance(index, (int, np.integer)):
+            return self.cube(index)
+        return CubeSet(self.data[index], self.levels)
+
+    def cube(self, i: int) -> Cube:
+        row = self.data[i]
+        return Cube(float(row['x']), float(row['y']), float(row['angle']), none_id(row['id']), none_id(row['parent_id']),
+                    self.levels, str(row['color']) or None)
+
+    def identified(self) -> 'CubeSet':
+        return self[(self.data['id'] != NO_ID) & (self.data['color'] != '')]
+
+    def sorted(self, key: str = 'id', reverse: bool = False) -> 'CubeSet':
+        order = np.argsort(self.data[key], kind='stable')
+        return self[order[::-1] if reverse else order]
+
+
+def optional_id(value) -> int:
+    return NO_ID if value is None else value
+
+
+def none_id(value) -> int:
+    return None if value == NO_ID else int(value)
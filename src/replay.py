@@ -0,0 +1,178 @@
+import os
+import glob
+import time
+
+import cv2 as cv
+import numpy as np
+
+from .archive import FrameArchive
+
+GAIN_MASK = 0xFFF
+
+
+class PROPERTY_TYPE:
+    """Values of PyCapture2.PROPERTY_TYPE, used when PyCapture2 is not installed"""
+    BRIGHTNESS = 0
+    WHITE_BALANCE = 3
+    SHUTTER = 12
+    GAIN = 13
+    FRAME_RATE = 16
+
+
+class PIXEL_FORMAT:
+    """Values of PyCapture2.PIXEL_FORMAT, used when PyCapture2 is not installed"""
+    BGR = 0x80000008
+
+
+class ReplayImage:
+    """Recorded frame with the subset of the PyCapture2.Image interface used by capture_images"""
+
+    def __init__(self, image: np.ndarray, gain: int):
+        self.image = image
+        self.gain = gain
+
+    def convert(self, pixel_format):
+        # The recorded frames are already BGR
+        return self
+
+    def getData(self) -> np.ndarray:
+        return self.image.reshape(-1)
+
+    def getRows(self) -> int:
+        return self.image.shape[0]
+
+    def getCols(self) -> int:
+        return self.image.shape[1]
+
+    def getMetadata(self):
+        return ReplayMetadata(self.gain)
+
+
+class ReplayMetadata:
+    def __init__(self, gain: int):
+        self.embeddedGain = gain
+
+
+class ReplayProperty:
+    def __init__(self, value_a: int, abs_value: float):
+        self.valueA = value_a
+        self.absValue = abs_value
+
+
+class ReplayCamera:
+    """Stand-in for PyCapture2.Camera that serves recorded frame sets, e.g. camera/images*.
+    Every directory holds one image per shade, named <shade>.png like the images saved by capture_images.
+    The shade is chosen by the gain, as in the 'gain' section of the camera configuration. A new frame is
+    delivered every 1/fps seconds and it shows the gain that was set 'latency' seconds before, so a gain change
+    takes effect with a delay like on the real camera. The next frame set is used when a shade that was already
+    served from the current set is requested again, i.e. on the next capture cycle.
+    The images of all directories are decoded when the camera is created (about 7 MiB per set of two 1280x960
+    images), so that serving a new set does not delay the frames. If 'archive' is set, the records of the
+    FrameArchive in that directory are replayed instead of the directories, as views of its mapped files.
+    Only the gain changes the image, the other properties are stored and returned by getProperty.
+    """
+
+    def __init__(self, config: dict):
+        """
+        :param config: camera configuration, the 'replay' section sets the parameters
+        """
+        params = config.get('replay', {})
+        self.fps = params.get('fps', 15)
+        self.latency = params.get('latency', 0.1)
+        self.loop = params.get('loop', True)
+        self.shades = {float(value): shade for shade, value in config['gain'].items()}
+
+        self.archive = None
+        if params.get('archive'):
+            self.archive = FrameArchive(params['archive'])
+            self.directories = [f'{params["archive"]}#{i}' for i in range(len(self.archive))]
+            sources = params['archive']
+        else:
+            sources = params.get('directories', ['camera/images*'])
+            self.directories = [directory for pattern in sources for directory in sorted(glob.glob(pattern))
+                                if all(os.path.isfile(os.path.join(directory, f'{shade}.png')) for shade in config['gain'])]
+        if not self.directories:
+            raise FileNotFoundError(f'No frame sets with the images {list(config["gain"])} found in {sources}')
+
+        # The frames are decoded here, decoding them when a set is served would delay the frame delivery
+        self.sets = None
+        if self.archive is None:
+            self.sets = [{shade: cv.imread(os.path.join(directory, f'{shade}.png')) for shade in self.shades.values()}
+                         for directory in self.directories]
+
+        self.set_index = -1
+        self.frames = {}
+        self.served = set()
+        self.shade_served = None
+        self.next_set()
+
+        self.properties = {}
+        self.gains = [(0.0, next(iter(self.shades.values())), 0)]
+        self.start = time.monotonic()
+        self.frame_index = 0
+
+    def next_set(self):
+        """Switches to the images of the next frame set"""
+        if self.set_index + 1 >= len(self.directories) and not self.loop:
+            raise EOFError('All frame sets were replayed')
+        index = (self.set_index + 1) % len(self.directories)
+        if index != self.set_index:
+            self.set_index = index
+            self.frames = self.sets[index] if self.sets is not None else self.archive.images(index)
+        self.served = set()
+
+    def connect(self, *args):
+        pass
+
+    def startCapture(self):
+        self.start = time.monotonic()
+        self.frame_index = 0
+
+    def stopCapture(self):
+        pass
+
+    def setEmbeddedImageInfo(self, **kwargs):
+        pass
+
+    def setProperty(self, type=None, absValue=None, **kwargs):
+        self.properties[type] = absValue
+        if type == PROPERTY_TYPE.GAIN and absValue is not None:
+            shade = self.shade(absValue)
+            self.gains.append((time.monotonic(), shade, self.register(absValue)))
+
+    def getProperty(self, type):
+        value = self.properties.get(type, 0.0)
+        return ReplayProperty(self.register(value), value)
+
+    def retrieveBuffer(self) -> ReplayImage:
+        """Waits for the next frame and returns the image of the shade active at its exposure"""
+        self.frame_index += 1
+        delivery = self.start + self.frame_index / self.fps
+        delay = delivery - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # The frames in between were dropped, like when the buffer of the camera is not drained
+            self.frame_index += int(-delay * self.fps)
+            delivery = time.monotonic()
+
+        # The gain changes that took effect before this exposure are no longer needed
+        exposure = delivery - self.latency
+        while len(self.gains) > 1 and self.gains[1][0] <= exposure:
+            self.gains.pop(0)
+        _, shade, register = self.gains[0]
+
+        if shade != self.shade_served and shade in self.served:
+            self.next_set()
+        self.served.add(shade)
+        self.shade_served = shade
+        return ReplayImage(self.frames[shade], register)
+
+    def shade(self, value: float) -> str:
+        """Shade of the gain closest to the value"""
+        return self.shades[min(self.shades, key=lambda gain: abs(gain - value))]
+
+    @staticmethod
+    def register(value: float) -> int:
+        """Register value of the gain as embedded in the frames, hundredths of the absolute value"""
+        return int(round(value * 100)) & GAIN_MASK
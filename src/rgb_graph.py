@@ -1,12 +1,16 @@
 import numpy as np
-import matplotlib.pyplot as plt
 
-import matplotlib
 
-matplotlib.use('TkAgg')
+def use_tk_backend():
+    """Switches matplotlib to the TkAgg backend, only when a graph is shown and not on import"""
+    import matplotlib
+    matplotlib.use('TkAgg')
 
 
 def plot_rgb_graph(image: np.ndarray, k: int = 5) -> None:
+    use_tk_backend()
+    import matplotlib.pyplot as plt
+
     fig = plt.figure()
     ax = fig.add_subplot(111, projection='3d')
 
@@ -25,6 +29,7 @@ def plot_rgb_graph(image: np.ndarray, k: int = 5) -> None:
 
 
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
     img = plt.imread('../colors/blue.png')
     plot_rgb_graph(img)
 
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+
+import cv2 as cv
+import numpy as np
+
+LEVELS = 256
+
+
+class ThresholdSchedule:
+    """Chooses the threshold levels of the contour sweep from the histogram of each channel and from
+    the levels that produced square candidates in the previous frames.
+    The seeds are the valleys and modes of the smoothed histogram and the levels that contributed before,
+    each seed is swept finely within 'radius' levels. A coarse grid over the whole range is swept as well,
+    so that new cubes at other levels can be found.
+    The state is kept per key (shade, channel and image size), for a limited number of keys.
+    """
+
+    def __init__(self, config: dict):
+        """
+        :param config: the 'adaptive' section of the detection configuration
+        """
+        self.coarse_step = config.get('coarse_step', 16)
+        self.radius = config.get('radius', 3)
+        self.smoothing = config.get('smoothing', 5)
+        self.min_mode = config.get('min_mode', 0.01)
+        self.decay = config.get('decay', 0.5)
+        self.min_score = config.get('min_score', 0.2)
+        self.max_keys = config.get('max_keys', 16)
+
+        self.scores = OrderedDict()
+        self.square_counts = {}
+
+    def has_history(self, key) -> bool:
+        return key in self.scores
+
+    def levels(self, channel: np.ndarray, key, lower: int = 0, upper: int = LEVELS) -> np.ndarray:
+        """Returns the sorted threshold levels to sweep in the channel
+        :param channel: single channel of the filtered image
+        :param key: key of the learned state, e.g. (shade, channel index, image shape)
+        :param lower: lowest level
+        :param upper: upper bound of the levels (exclusive)
+        """
+        hist = cv.calcHist([channel], [0], None, [LEVELS], [0, LEVELS]).ravel()
+        kernel = cv.getGaussianKernel(2 * self.smoothing + 1, -1).ravel()
+        smooth = np.convolve(hist, kernel, mode='same')
+        slope = np.diff(smooth)
+
+        # Modes are the cube colors and the background, the deepest valley between two modes separates them
+        modes = np.flatnonzero((slope[:-1] > 0) & (slope[1:] <= 0)) + 1
+        modes = modes[smooth[modes] >= self.min_mode * channel.size]
+        valleys = np.array([a + np.argmin(smooth[a:b]) for a, b in zip(modes[:-1], modes[1:])], dtype=int)
+        learned = np.flatnonzero(self.scores[key] >= self.min_score) if key in self.scores else []
+
+        seeds = np.unique(np.concatenate([valleys, modes, learned])).astype(int)
+        levels = np.concatenate([(seeds[:, None] + np.arange(-self.radius, self.radius + 1)).ravel(),
+                                 np.arange(lower, upper, self.coarse_step)])
+        return np.unique(levels[(levels >= lower) & (levels < upper)]).astype(int)
+
+    def learn(self, key, contributed: np.ndarray):
+        """Updates the scores of the levels with the levels at which the squares of this frame were found
+        :param key: key of the learned state
+        :param contributed: boolean array of length 256
+        """
+        scores = self.scores.pop(key, np.zeros(LEVELS))
+        self.scores[key] = self.decay * scores + (1 - self.decay) * contributed
+        if len(self.scores) > self.max_keys:
+            self.scores.popitem(last=False)
+
+    def expected_squares(self, key) -> int:
+        """Number of squares found in the previous frame, the adaptive sweep must not find fewer"""
+        return self.square_counts.get(key, 0)
+
+    def update_squares(self, key, count: int):
+        self.square_counts[key] = count
+        if len(self.square_counts) > self.max_keys:
+            del self.square_counts[next(iter(self.square_counts))]